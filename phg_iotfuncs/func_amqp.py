@@ -85,12 +85,6 @@ class PhGAMQPPreload(func_base.PhGCommonPreload):
         ]
         return (inputs, outputs)
 
-    @classmethod
-    def get_module_files(cls,pattern):
-        module_path=os.path.dirname(importlib.import_module(cls.__module__).__file__)
-        logger.debug(f"module_path={module_path}")
-        return [f for f in os.listdir(module_path) if fnmatch.fnmatch(f,pattern)],module_path
-
     def preload(self,entity_type,db,table,entityMetaDict,params,entity_meta_dict,last_seq):
         """
             Implement the preload code
@@ -105,7 +99,8 @@ class PhGAMQPPreload(func_base.PhGCommonPreload):
 
         # Get data from IoT Event Hub
         from phg_iotfuncs import amqp_helper
-        msgs=amqp_helper.amqpReceive(self.iot_hub_name,self.policy_name,self.consumer_group,self.partition_id,self.access_key,timeout=1000,since_seq=last_seq+1)
+        with self.memTracker.stage('amqpReceive'):
+            msgs=amqp_helper.amqpReceive(self.iot_hub_name,self.policy_name,self.consumer_group,self.partition_id,self.access_key,timeout=1000,since_seq=last_seq+1)
 
         # If no records, return imediatelly
         if len(msgs)==0:
@@ -131,6 +126,7 @@ class PhGAMQPPreload(func_base.PhGCommonPreload):
 
         # We get the messages in an array of dicts, convert to dataframe
         df=pd.DataFrame.from_dict(msgs)
+        self.memTracker.recordObject('df from messages',df)
         logger.info(f"df initial columns={[c for c in df.columns]}")
 
         # Find the date column. We know at this stage that the records we keep have a date_field
@@ -19,13 +19,13 @@ import logging,pprint
 from iotfunctions.base import BaseTransformer, BaseDataSource, BasePreload, BaseFilter
 import iotfunctions.db
 
-from phg_iotfuncs import iotf_utils
+from phg_iotfuncs import iotf_utils, perf_utils
 
 logger = logging.getLogger(__name__)
 
 PACKAGE_URL = f"git+https://github.com/philippe-gregoire/mas_iotfuncs@master"
 
-class PhGCommonPreload(BasePreload):
+class PhGCommonPreload(perf_utils.ProfiledMixin, BasePreload):
     """
     CommonPreload
     Abstract base class with common code for all preload.
@@ -39,12 +39,9 @@ class PhGCommonPreload(BasePreload):
         self.lastseq_init=lastseq_init
 
         self.logger=logging.getLogger(self.__class__.__name__)
+        self.memTracker=perf_utils.MemoryTracker(self.__class__.__name__,enabled=False,logger=self.logger)
 
-    @classmethod
-    def get_module_files(cls,pattern):
-        module_path=os.path.dirname(importlib.import_module(cls.__module__).__file__)
-        logging.getLogger(cls.__name__).info(f"class {cls.__name__} module_path={module_path}")
-        return [f for f in os.listdir(module_path) if fnmatch.fnmatch(f,pattern)],module_path
+    get_module_files = classmethod(iotf_utils.moduleFiles)
 
     def execute(self, df, start_ts=None, end_ts=None, entities=None):
         ''' When extending this class, do not override execute(), but implement preload()
@@ -54,29 +51,38 @@ class PhGCommonPreload(BasePreload):
         import numpy as np, pandas as pd
         import datetime as dt
 
-        # Extract useful values
-        entity_type = self.get_entity_type()
-        self.logger.info(f"entity_type name={entity_type.name} logical_name={entity_type.logical_name}")
+        # Profile the run when enabled through environment or profile_dir
+        with self.profiledRun(logger=self.logger):
+            # Track per-stage peak memory when enabled through environment
+            self.memTracker=perf_utils.MemoryTracker(self.__class__.__name__,logger=self.logger).start()
+
+            # Extract useful values
+            entity_type = self.get_entity_type()
+            self.logger.info(f"entity_type name={entity_type.name} logical_name={entity_type.logical_name}")
 
-        db = entity_type.db
-        self.logger.debug(f"entity_type_metadata keys={db.entity_type_metadata.keys()} ")
+            db = entity_type.db
+            self.logger.debug(f"entity_type_metadata keys={db.entity_type_metadata.keys()} ")
 
-        # get entity metadata
-        entityMetaDict=db.entity_type_metadata[entity_type.name] if entity_type.name in db.entity_type_metadata else db.entity_type_metadata[entity_type.logical_name]
-        self.logger.debug(f"Got entityMetaDict of type {type(entityMetaDict)} value={entityMetaDict}")
+            # get entity metadata
+            entityMetaDict=db.entity_type_metadata[entity_type.name] if entity_type.name in db.entity_type_metadata else db.entity_type_metadata[entity_type.logical_name]
+            self.logger.debug(f"Got entityMetaDict of type {type(entityMetaDict)} value={entityMetaDict}")
 
-        params,entity_meta_dict=iotfunctions.metadata.retrieve_entity_type_metadata(_db=db,logical_name=entity_type.logical_name)
-        self.logger.debug(f"Retrieved entity_meta of type {type(entity_meta_dict)}")
-        self.logger.debug(pprint.pformat(entity_meta_dict))
+            params,entity_meta_dict=iotfunctions.metadata.retrieve_entity_type_metadata(_db=db,logical_name=entity_type.logical_name)
+            self.logger.debug(f"Retrieved entity_meta of type {type(entity_meta_dict)}")
+            self.logger.debug(pprint.pformat(entity_meta_dict))
 
-        # get global constant (Current bug with entity-constant)
-        last_seq=iotf_utils.getConstant(entity_type.db,self.lastseq_constant,self.lastseq_init,auto_register=True,const_type=self.lastseq_type)
+            # get global constant (Current bug with entity-constant)
+            last_seq=iotf_utils.getConstant(entity_type.db,self.lastseq_constant,self.lastseq_init,auto_register=True,const_type=self.lastseq_type)
 
-        # This class is setup to write to the entity time series table
-        table = entity_type.name
+            # This class is setup to write to the entity time series table
+            table = entity_type.name
 
-        # Call the virtual call-back to perform preload
-        return self.preload(entity_type,db,table,entityMetaDict,params,entity_meta_dict,last_seq)
+            # Call the virtual call-back to perform preload
+            try:
+                with self.memTracker.stage('preload'):
+                    return self.preload(entity_type,db,table,entityMetaDict,params,entity_meta_dict,last_seq)
+            finally:
+                self.memTracker.report()
 
     def preload(self,entity_type,db,table,entityMetaDict,params,entity_meta_dict,last_seq):
         """
@@ -94,44 +100,141 @@ class PhGCommonPreload(BasePreload):
         """
         Store the Preload data, to be used by preload override
         """
-        iotf_utils.adjustDataFrameColumns(db,entity_meta_dict,df,event_type,force_upper_columns)
+        with self.memTracker.stage('adjustDataFrameColumns'):
+            iotf_utils.adjustDataFrameColumns(db,entity_meta_dict,df,event_type,force_upper_columns)
+        self.memTracker.recordObject('df after adjustDataFrameColumns',df)
 
         self.logger.info(f"Writing df {df.shape} to {entity_meta_dict['metricsTableName']}")
-        self.write_frame(df=df, table_name=entity_meta_dict['metricsTableName'])
+        with self.memTracker.stage('write_frame'):
+            # Frames over the memory threshold are written in chunks
+            for chunk in self.memTracker.chunks(df):
+                self.write_frame(df=chunk, table_name=entity_meta_dict['metricsTableName'])
         self.logger.debug(f"Wrote {len(df.index)} rows to table {entity_meta_dict['schemaName']}.{entity_meta_dict['metricsTableName']}")
 
         return True
 
-class PhGFilterMultiplicates(BaseFilter):
+class PhGFilterMultiplicates(perf_utils.ProfiledMixin, BaseFilter):
     """
     Filters out multiplicate consecutive rows (rows with same values but different timestamps)
     """
-
-    def __init__(self, drop_if_NaN, timestamp_column, keep_timestamp, filter_set=None):
+    def __init__(self, drop_if_NaN, timestamp_column, keep_timestamp, filter_set=None, compare_columns=None):
         super().__init__(dependent_items=keep_timestamp, output_item=filter_set)
         self.timestamp_column = timestamp_column
         self.drop_if_NaN = drop_if_NaN
         self.keep_timestamp = keep_timestamp
         self.filter_set = filter_set
+        self.compare_columns = compare_columns
 
     def filter(self, df):
-        # Implement the logic
-        logger.info(f"Got dataframe of len={len(df)}")
-        logger.info(f"columns= {', '.join([c for c in df.columns])}")
-        logger.info(df.describe(include='all'))
-        # df is indexed by (id,date)
-
-        # drop the rows for which not all the Order[1-3]_fftV|G are non-NaN
-        import math
-        drop_if_NaN = self.drop_if_NaN
-        # drop_if_NaN = [f"Order{o}_fft{f}" for o in (1,2,3) for f in ('V','G')]
-        logger.info(f"Dropping rows if any of {drop_if_NaN} is NaN")
-        df=df[df[drop_if_NaN].apply(lambda row: all([not math.isnan(c) for c in row]),axis=1)]
-
-        logger.info(f"Now having retained {len(df)} rows")
-        logger.info(df.describe(include='all'))
-        
-        return df
+        # Profile the run when enabled through environment or profile_dir
+        with self.profiledRun(logger=logger):
+            # Implement the logic
+            logger.info(f"Got dataframe of len={len(df)}")
+            logger.info(f"columns= {', '.join([c for c in df.columns])}")
+            # describe() scans every column, only compute it when debugging
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(df.describe(include='all'))
+            # df is indexed by (id,date)
+
+            # drop the rows for which not all the Order[1-3]_fftV|G are non-NaN
+            drop_if_NaN = self.drop_if_NaN
+            # drop_if_NaN = [f"Order{o}_fft{f}" for o in (1,2,3) for f in ('V','G')]
+            logger.info(f"Dropping rows if any of {drop_if_NaN} is NaN")
+            df=df[df[drop_if_NaN].notna().all(axis=1)]
+
+            logger.info(f"Now having retained {len(df)} rows")
+
+            # Collapse runs of consecutive identical values, per device
+            df=self.collapseRuns(df)
+
+            logger.info(f"Now having retained {len(df)} rows after collapsing multiplicates")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(df.describe(include='all'))
+
+            return df
+
+    def collapseRuns(self, df):
+        """
+        Keep one row per run of consecutive rows with identical values in the
+        compared columns for the same device. The timestamp of the kept row is the
+        min, mean or max of the run timestamps according to keep_timestamp.
+        df is expected sorted on its (id,date) index, as delivered by the pipeline
+        """
+        import numpy as np, pandas as pd
+
+        if len(df)<2:
+            return df
+        columns=self._compareColumns(df)
+        if len(columns)==0:
+            logger.warning(f"No column to compare, not collapsing rows")
+            return df
+        if not df.index.is_monotonic_increasing:
+            df=df.sort_index()
+
+        keep=self.keep_timestamp if isinstance(self.keep_timestamp,str) else (self.keep_timestamp or ['min'])[0]
+        ids=df.index.get_level_values(0).to_numpy()
+
+        # A run starts on the first row, on a device change or on a value change, NaNs being equal
+        run_start=np.empty(len(df),dtype=bool)
+        run_start[0]=True
+        run_start[1:]=ids[1:]!=ids[:-1]
+        for c in columns:
+            v=df[c].to_numpy()
+            na=pd.isna(v)
+            run_start[1:]|=(v[1:]!=v[:-1]) & ~(na[1:] & na[:-1])
+        logger.info(f"Collapsing {len(df)} rows into {run_start.sum()} runs keeping {keep} timestamp")
+
+        if keep=='max':
+            # Keep the last row of each run
+            kept=np.empty(len(df),dtype=bool)
+            kept[:-1]=run_start[1:]
+            kept[-1]=True
+            return df[kept]
+
+        dfKept=df[run_start]
+        if keep=='mean':
+            # Mean as offset from the run's first timestamp, to keep nanosecond precision
+            ts=self._timestamps(df).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+            run=np.cumsum(run_start)-1
+            first=ts[run_start]
+            offsets=np.bincount(run,weights=ts-first[run])/np.bincount(run)
+            ts_mean=pd.to_datetime(first+offsets.astype(np.int64))
+            dfKept=dfKept.copy()
+            for c in self._timestampColumns(df):
+                dfKept[c]=ts_mean
+            dfKept.index=pd.MultiIndex.from_arrays([dfKept.index.get_level_values(0),ts_mean],names=dfKept.index.names)
+        return dfKept
+
+    def _compareColumns(self, df):
+        """
+        Columns whose changes start a new run: compare_columns, or all but the entity id
+        and the datetime columns, such as the timestamp copies and updated_utc
+        """
+        import pandas as pd
+        if self.compare_columns:
+            return [self.compare_columns] if isinstance(self.compare_columns,str) else list(self.compare_columns)
+        excluded={self.timestamp_column,self.filter_set,self._entityIdColumn(),*df.index.names}
+        return [c for c in df.columns if c not in excluded and not pd.api.types.is_datetime64_any_dtype(df[c].dtype)]
+
+    def _entityIdColumn(self):
+        """ Name of the entity id column, deviceid when the entity type is not known """
+        try:
+            return self.get_entity_type()._entity_id
+        except Exception:
+            return 'deviceid'
+
+    def _timestampColumns(self, df):
+        """ timestamp_column and the datetime columns holding the same timestamps as the date index level """
+        import pandas as pd
+        ts=df.index.get_level_values(1)
+        return [c for c in df.columns if c==self.timestamp_column or
+                (pd.api.types.is_datetime64_any_dtype(df[c].dtype) and (df[c].to_numpy()==ts.to_numpy()).all())]
+
+    def _timestamps(self, df):
+        """ Timestamps from timestamp_column, or from the date index level when not a column """
+        if self.timestamp_column in df.columns:
+            return df[self.timestamp_column]
+        return df.index.get_level_values(1)
 
     @classmethod
     def build_ui(cls):
@@ -140,5 +243,7 @@ class PhGFilterMultiplicates(BaseFilter):
         # define arguments that behave as function inputs
         inputs = [ui.UIMultiItem(name='drop_if_NaN', datatype=float),
                   ui.UISingleItem(name='timestamp_column', datatype=datetime.datetime),
-                  ui.UIMulti(name='keep_timestamp', datatype=str, values=['min', 'mean', 'max'])]
+                  ui.UIMulti(name='keep_timestamp', datatype=str, values=['min', 'mean', 'max']),
+                  ui.UIMultiItem(name='compare_columns', datatype=None, required=False,
+                                 description='Columns compared to detect multiplicate rows, default all but the device id and datetime columns')]
         return (inputs, [ui.UIStatusFlag('filter_set')])
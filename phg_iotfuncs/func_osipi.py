@@ -113,7 +113,9 @@ class PhGOSIElemsPreload(func_base.PhGCommonPreload):
         # Get the specified Points attributes fields from OSIServer
         attrFields=[osipiutils.ATTR_FIELD_VAL,osipiutils.ATTR_FIELD_TS]
         from phg_iotfuncs import osipiutils
-        elemVals,_=osipiutils.getOSIPiElements(self.srvParams,self.parent_element_path,attrFields,DEVICE_ATTR,startTime=last_seq,interval=self.interval,logger=self.logger)
+        with self.memTracker.stage('getOSIPiElements'):
+            elemVals,_=osipiutils.getOSIPiElements(self.srvParams,self.parent_element_path,attrFields,DEVICE_ATTR,startTime=last_seq,interval=self.interval,logger=self.logger)
+        self.memTracker.recordObject('elemVals',elemVals)
 
         # If no records, return immediately
         if len(elemVals)==0:
@@ -122,7 +124,9 @@ class PhGOSIElemsPreload(func_base.PhGCommonPreload):
         self.logger.info(f"Retrieved messages for {len(elemVals)} attributes")
        
         # Get into DataFrame table form indexed by timestamp 
-        df=osipiutils.convertToEntities(elemVals,self.date_field,DEVICE_ATTR,logger=self.logger)
+        with self.memTracker.stage('convertToEntities'):
+            df=osipiutils.convertToEntities(elemVals,self.date_field,DEVICE_ATTR,logger=self.logger)
+        self.memTracker.recordObject('df after convertToEntities',df)
 
         # Set format to the interval value
         if self.interval:
@@ -205,7 +209,9 @@ class PhGOSIPIPointsPreload(func_base.PhGCommonPreload):
     
         # Get the specified Points attributes fields from OSIServer
         attrFields=[osipiutils.ATTR_FIELD_VAL,osipiutils.ATTR_FIELD_TS]
-        ptVals=osipiutils.getOSIPiPoints(self.srvParams,self.name_filter,attrFields,logger=self.logger)
+        with self.memTracker.stage('getOSIPiPoints'):
+            ptVals=osipiutils.getOSIPiPoints(self.srvParams,self.name_filter,attrFields,logger=self.logger)
+        self.memTracker.recordObject('ptVals',ptVals)
     
         # If no records, return immediately
         if len(ptVals)==0:
@@ -216,7 +222,9 @@ class PhGOSIPIPointsPreload(func_base.PhGCommonPreload):
         flattened=osipiutils.mapPointValues(ptVals,DEVICE_ATTR,self.points_attr_map,logger=self.logger)
         
         # Get into DataFrame table form indexed by timestamp 
-        df=osipiutils.convertToEntities(flattened,self.date_field,DEVICE_ATTR,logger=self.logger)
+        with self.memTracker.stage('convertToEntities'):
+            df=osipiutils.convertToEntities(flattened,self.date_field,DEVICE_ATTR,logger=self.logger)
+        self.memTracker.recordObject('df after convertToEntities',df)
 
         # Store the highest sequence number
         max_timestamp=df[self.date_field].max()
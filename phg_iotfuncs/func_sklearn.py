@@ -23,6 +23,8 @@ import pandas as pd
 from iotfunctions.base import BaseTransformer, BaseDataSource, BasePreload
 from iotfunctions import base, ui, bif, anomaly,estimator
 
+from phg_iotfuncs import iotf_utils, perf_utils, model_utils
+
 logger = logging.getLogger(__name__)
 
 # Specify the URL to your package here.
@@ -34,11 +36,25 @@ logger = logging.getLogger(__name__)
 
 PACKAGE_URL = f"git+https://github.com/philippe-gregoire/mas_iotfuncs@master"
 
+def newIndexMask(index,existing_index):
+    """ Boolean mask of the index entries not in existing_index, keeping the first of duplicate keys """
+    return ~index.isin(existing_index) & ~index.duplicated(keep='first')
+
+def indexSummary(index):
+    """ Short description of an (id,timestamp) index for logging """
+    if len(index)==0:
+        return "no rows"
+    timestamps=index.get_level_values(1)
+    return f"{len(index)} rows for {index.get_level_values(0).nunique()} devices from {timestamps.min()} to {timestamps.max()}"
+
 class ExtendEntityPreload(BasePreload):
     """
         ExtendEntityPreload
         This function extends the EntityData from another Entity, filling-in timestamps
     """
+    # Seconds re-read before the last read timestamp, to catch late-arriving rows
+    cache_overlap = 60
+
     def __init__(self, source_entity_type_name, ts_interval, ts_lapse, extend_entity_ok):
         logger.info(f"ExtendEntityPreload __init__")
         super().__init__(dummy_items=[], output_item=extend_entity_ok)
@@ -109,8 +125,9 @@ class ExtendEntityPreload(BasePreload):
         end_ts=datetime.utcnow()
         start_ts=end_ts-timedelta(seconds=self.ts_lapse)
 
-        # get data for this entity
-        df = entity_type.get_data(start_ts=start_ts, end_ts=end_ts, entities=None, columns=None)
+        # get data for this entity, only reading what is new since the last run
+        targetCache=iotf_utils.getWindowCache(entity_type.name,self.cache_overlap,window=self.ts_lapse)
+        df = targetCache.getData(entity_type, start_ts, end_ts, logger=logger)
         logger.info(f"Got this df of len {len(df)} cols={df.columns} from {start_ts} to {end_ts}")
         # drop devicetype columnName
         df=df[[c for c in df.columns if c!='devicetype']]
@@ -121,22 +138,24 @@ class ExtendEntityPreload(BasePreload):
         # cols.extend(self.input_items)
         # renamed_cols = [target._entity_id, target._timestamp]
         # renamed_cols.extend(self.output_items)
-        dfSource = sourceEntity.get_data(start_ts=start_ts, end_ts=end_ts, entities=None, columns=None)
+        sourceCache=iotf_utils.getWindowCache(f"{sourceEntity.name}>{entity_type.name}",self.cache_overlap,window=self.ts_lapse)
+        dfSource = sourceCache.getData(sourceEntity, start_ts, end_ts, columns=sourceCache.columns, logger=logger)
 
         logger.info(f"Got source df of len {len(dfSource)} cols={dfSource.columns} from {start_ts} to {end_ts}")
         if len(dfSource)>0:
             logger.debug(f"dfSource[0]={dfSource.iloc[0].to_dict()}")
 
         common_cols=[c for c in df.columns if c in dfSource.columns]
-        dfSource=dfSource[common_cols]
+        # Only the common columns will be read from the source from now on
+        sourceCache.project(common_cols)
+        dfSource=sourceCache.df
 
         # Keep only the data from dfSource that is not already in df, based on index
-        keepSource=[i for i in dfSource.index if i not in df.index]
-        logger.info(f"Keeping {len(keepSource)} indices {keepSource}")
+        keepSource=newIndexMask(dfSource.index,df.index)
+        logger.info(f"Keeping {keepSource.sum()} of {len(dfSource)} source rows: {indexSummary(dfSource.index[keepSource])}")
 
-        if len(keepSource)>0:
-            dfSource=dfSource.loc[keepSource]
-            dfSource.drop_duplicates(inplace=True)
+        if keepSource.any():
+            dfSource=dfSource[keepSource]
             logger.info(f"dfSource after filtering len={len(dfSource)}")
 
             # Add the new data from dfSource to current df
@@ -151,54 +170,76 @@ class ExtendEntityPreload(BasePreload):
         # Add back the device type column
         dfNew['devicetype']=entity_type.logical_name
 
-        # generate new values since the last timestamp and now
+        # generate new values since each device's last timestamp and now
         dfNew.sort_index(inplace=True)
-        ix_latest=dfNew.index[-1]
-        ts_latest=ix_latest[1]
-        td=(end_ts-ts_latest).total_seconds()
-        missing=int(td/self.ts_interval)
-
-        # We base the values on the last Telemetry event, to avoid skipping over
-        dfTelemetry=dfNew[dfNew['eventtype']=='Telemetry']
-        last_row=dfTelemetry.iloc[-1] if len(dfTelemetry)>0 else dfNew.iloc[-1]
-
-        logger.info(f"latest={ts_latest} elapsed={td}, adding {missing} rows from {last_row.to_dict()}")
-        for i in range(1,1+missing):
-            ts_fill=ts_latest+timedelta(seconds=i*self.ts_interval)
-            new_row=last_row.copy()
-            new_row['eventtype']=f"Fill_{self.ts_interval}_sec"
-            new_row['_timestamp']=ts_fill
-            #new_row['rcv_timestamp_utc']=ts_fill   # Keep TS of original event
-            new_row['updated_utc']=datetime.utcnow()
-            last_row.name=(ix_latest[0],ts_fill)
-            logger.debug(f"append {(ix_latest[0],ts_fill)}={new_row}, len={len(dfNew)}")
-            dfNew=dfNew.append(new_row)
+        dfFill=self.fillRows(dfNew,end_ts)
+        if len(dfFill)>0:
+            dfNew=pd.concat([dfNew,dfFill],axis=0)
 
         # Write back new data in db
-        keepNew=[i for i in dfNew.index if i not in df.index]
-        if len(keepNew)>0:
-            dfNew=dfNew.loc[keepNew]
-            dfNew.drop_duplicates(inplace=True)
-            logger.info(f"Writing dfNew {dfNew.shape} to {table}")
+        keepNew=newIndexMask(dfNew.index,df.index)
+        if keepNew.any():
+            dfNew=dfNew[keepNew]
+            logger.info(f"Writing dfNew {dfNew.shape} to {table}: {indexSummary(dfNew.index)}")
             self.write_frame(df=dfNew, table_name=table)
+            # Written rows are in the target window but will not be re-read
+            targetCache.merge(dfNew)
         else:
             logger.info(f"No new row to write")
 
         return True
 
-class PredictSKLearn(BaseTransformer):
+    def fillRows(self, dfNew, end_ts):
+        """
+        Build the fill rows for every device, repeating its last row (last Telemetry
+        row when there is one) every ts_interval seconds from its latest timestamp up to end_ts
+        dfNew must be sorted on its (id,timestamp) index
+        """
+        from datetime import datetime
+
+        # Latest row per device gives the fill start timestamp
+        latest=dfNew.groupby(level=0,sort=False).tail(1)
+        device_ids=latest.index.get_level_values(0)
+        ts_latest=pd.Series(latest.index.get_level_values(1),index=device_ids)
+
+        # We base the values on the last Telemetry event, to avoid skipping over
+        dfTelemetry=dfNew[dfNew['eventtype']=='Telemetry']
+        base=pd.concat([dfTelemetry.groupby(level=0,sort=False).tail(1),latest]).droplevel(1)
+        base=base[~base.index.duplicated(keep='first')].loc[device_ids]
+
+        missing=((end_ts-ts_latest).dt.total_seconds()//self.ts_interval).clip(lower=0).astype(int).to_numpy()
+        logger.info(f"Adding {missing.sum()} fill rows for {len(device_ids)} devices, latest={ts_latest.to_dict()}")
+        if missing.sum()==0:
+            return dfNew.iloc[0:0]
+
+        # Repeat each device's base row as many times as it has missing intervals
+        rows=np.repeat(np.arange(len(base)),missing)
+        step=np.arange(len(rows))-np.repeat(np.cumsum(missing)-missing,missing)+1
+        ts_fill=np.repeat(ts_latest.to_numpy(),missing)+pd.to_timedelta(step*self.ts_interval,unit='s')
+
+        dfFill=base.iloc[rows].copy()
+        dfFill['eventtype']=f"Fill_{self.ts_interval}_sec"
+        dfFill['_timestamp']=ts_fill
+        #dfFill['rcv_timestamp_utc']=ts_fill   # Keep TS of original event
+        dfFill['updated_utc']=datetime.utcnow()
+        dfFill.index=pd.MultiIndex.from_arrays([dfFill.index,ts_fill],names=dfNew.index.names)
+        return dfFill
+
+class PredictSKLearn(perf_utils.ProfiledMixin, BaseTransformer):
     """
     PredictSKLearn
     Apply a sklearn predict() pipeline to a df
     """
-
-    def __init__(self, model_path, dependent_variables, predicted_value):
+    def __init__(self, model_path, dependent_variables, predicted_value, chunk_size=None, n_workers=None, incremental=False):
         super().__init__()
 
         # create an instance variable with the same name as each arg
         self.model_path = model_path
         self.dependent_variables=dependent_variables
         self.predicted_value = predicted_value
+        self.chunk_size = chunk_size
+        self.n_workers = n_workers
+        self.incremental = incremental
 
         # do not do any processing in the init() method. Processing will be done in the execute() method.
 
@@ -210,8 +251,11 @@ class PredictSKLearn(BaseTransformer):
 
         # define arguments that behave as function inputs
         inputs = [
-            ui.UISingle(required=True, datatype=str, name='model_path', description='Path of sklearn pickle file'),
-            ui.UIMultiItem(required=True, datatype=str, name='dependent_variables', description="Columns to provide to the model's predict() function")
+            ui.UISingle(required=True, datatype=str, name='model_path', description='Path of sklearn pickle file, or per-device template such as models/{deviceid}.pkl'),
+            ui.UIMultiItem(required=True, datatype=str, name='dependent_variables', description="Columns to provide to the model's predict() function"),
+            ui.UISingle(required=False, datatype=int, name='chunk_size', description='Rows per predict() call, blank to predict all rows at once'),
+            ui.UISingle(required=False, datatype=int, name='n_workers', description='Number of chunks predicted in parallel, default 1'),
+            ui.UISingle(required=False, datatype=bool, name='incremental', description='Only score rows newer than the previous run, reusing earlier predictions')
         ]
 
         # define arguments that behave as function outputs
@@ -220,59 +264,152 @@ class PredictSKLearn(BaseTransformer):
         ]
         return (inputs, outputs)
 
-    @classmethod
-    def get_module_files(cls,pattern):
-        module_path=os.path.dirname(importlib.import_module(cls.__module__).__file__)
-        logger.debug(f"module_path={module_path}")
-        return [f for f in os.listdir(module_path) if fnmatch.fnmatch(f,pattern)],module_path
+    get_module_files = classmethod(iotf_utils.moduleFiles)
 
     def execute(self, df, start_ts=None, end_ts=None, entities=None):
         '''
         '''
-        import iotfunctions.metadata
+        # Profile the run when enabled through environment or profile_dir
+        with self.profiledRun(logger=logger):
+            import iotfunctions.metadata
 
-        # Extract useful values
-        entity_type = self.get_entity_type()
-        logger.info(f"entity_type name={entity_type.name} logical_name={entity_type.logical_name}")
+            # Extract useful values
+            entity_type = self.get_entity_type()
+            logger.info(f"entity_type name={entity_type.name} logical_name={entity_type.logical_name}")
 
-        db = entity_type.db
-        logger.debug(f"entity_type_metadata keys={db.entity_type_metadata.keys()} ")
+            db = entity_type.db
+            logger.debug(f"entity_type_metadata keys={db.entity_type_metadata.keys()} ")
 
-        # get entity metadata
-        entityMetaDict=db.entity_type_metadata[entity_type.name] if entity_type.name in db.entity_type_metadata else db.entity_type_metadata[entity_type.logical_name]
-        logger.debug(f"Got entityMeta of type {type(entityMetaDict)} value={entityMetaDict}")
+            # get entity metadata
+            entityMetaDict=db.entity_type_metadata[entity_type.name] if entity_type.name in db.entity_type_metadata else db.entity_type_metadata[entity_type.logical_name]
+            logger.debug(f"Got entityMeta of type {type(entityMetaDict)} value={entityMetaDict}")
 
-        logger.info(f"df shape={df.shape}")
-        logger.info(f"df.head(2) ={df.head(2)}")
+            logger.info(f"df shape={df.shape}")
+            logger.info(f"df.head(2) ={df.head(2)}")
 
-        import iotfunctions.metadata
+            import iotfunctions.metadata
 
-        # This class is setup to write to the entity time series table
-        table = entity_type.name
-        schema = entity_type._db_schema
+            # This class is setup to write to the entity time series table
+            table = entity_type.name
+            schema = entity_type._db_schema
 
-        import sklearn
-        logger.info(f"Running sklearn version {sklearn.__version__}")
+            import sklearn
+            logger.info(f"Running sklearn version {sklearn.__version__}")
+
+            # this returns a pickled model, loaded once per process through the model cache
+            # With a model_path template such as models/{deviceid}.pkl, models are loaded per device when predicting
+            model=None
+            routed=self.isRouted()
+            try:
+                if routed:
+                    logger.info(f"Routing rows to per-device models {self.model_path}")
+                else:
+                    model,version=model_utils.loadModelVersion(db, self.model_path, logger=logger)
+                    logger.info(f"Model loaded {model}")
+            except Exception as exc:
+                logger.error(f"Error loading model from {self.model_path}",exc)
+                df[self.predicted_value]=f"ERROR {sklearn.__version__}"
+
+            if routed or model is not None:
+                # if dependent_variables have been specified, use for prediction
+                try:
+                    devices=df.index.unique(level=0)
+                    if routed:
+                        models,versions=self.loadRouted(db,devices)
+                        predict=lambda d: self.predictRouted(d,models)
+                    else:
+                        predict=lambda d: self.predict(model,d)
+                        versions={d:version for d in devices}
+                    if self.incremental:
+                        # Only score rows newer than the last run, reuse the previous predictions for the others
+                        scores=model_utils.getIncrementalScores((entity_type.name,self.model_path,self.predicted_value))
+                        # Rows of devices whose model was reloaded are all scored again
+                        scores.checkVersions(versions)
+                        toScore=scores.toScore(df.index)
+                        logger.info(f"Incremental scoring of {toScore.sum()} new rows out of {len(df)}")
+                        predicted=predict(df[toScore]) if toScore.any() else None
+                        df[self.predicted_value]=scores.combine(df.index,toScore,predicted)
+                        scores.update(df.index,df[self.predicted_value].to_numpy())
+                    else:
+                        df[self.predicted_value]=predict(df)
+                    logger.info(f"Model predicted")
+                except Exception as exc:
+                    logger.error(f"Model predict error",exc)
+            else:
+                logger.error(f"No model loaded model from {self.model_path}")
+                df[self.predicted_value]=f"NoModel {sklearn.__version__}"
+
+            return df
+
+    def isRouted(self):
+        """ True when model_path is a per-device template such as models/{deviceid}.pkl """
+        return '{deviceid}' in self.model_path
+
+    def loadRouted(self, db, device_ids):
+        """
+        Load the per-device models in parallel, returns the dicts of models and of their
+        versions by device id, None when not loaded.
+        Room is reserved in the model cache for all the devices, so that their models are kept between runs
+        """
+        import concurrent.futures
 
-        # this returns a pickled model
-        try:
-            model=db.cos_load(self.model_path, binary=True)
-            logger.info(f"Model loaded {model}")
-        except Exception as exc:
-            logger.error(f"Error loading model from {self.model_path}",exc)
-            df[self.predicted_value]=f"ERROR {sklearn.__version__}"
+        model_utils.getModelCache().reserve(self.model_path,len(device_ids))
 
-        if model is not None:
-            # if dependent_variables have been specified, use for prediction
-            dfX=df if self.dependent_variables=='*' else df[self.dependent_variables]
+        def loadDevice(device_id):
+            model_path=self.model_path.format(deviceid=device_id)
             try:
-                logger.info(f"Model predict() on {len(df)} rows and {len(dfX.columns)} columns: {dfX.columns} original: {df.columns}")
-                df[self.predicted_value]=model.predict(dfX)
-                logger.info(f"Model predicted")
+                return model_utils.loadModelVersion(db,model_path,logger=logger)
             except Exception as exc:
-                logger.error(f"Model predict error",exc)
-        else:
-            logger.error(f"No model loaded model from {self.model_path}")
-            df[self.predicted_value]=f"NoModel {sklearn.__version__}"
+                logger.error(f"Could not load model {model_path} for device {device_id}: {exc}")
+                return None,None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,self.n_workers or 1)) as pool:
+            loaded=list(pool.map(loadDevice,device_ids))
+        return {d:m for d,(m,_) in zip(device_ids,loaded)},{d:v for d,(_,v) in zip(device_ids,loaded)}
+
+    def predictRouted(self, df, models):
+        """
+        Predict df rows with the models of loadRouted(), each device's rows in predict()
+        calls of chunk_size rows, devices scored in parallel by n_workers threads
+        """
+        import concurrent.futures
 
-        return df
+        groups=df.groupby(level=0,sort=False).indices
+        logger.info(f"Predicting {len(df)} rows for {len(groups)} devices")
+        # A single device gets the workers for its chunks
+        chunk_workers=self.n_workers if len(groups)==1 else 1
+
+        def predictGroup(device_id,rows):
+            model=models.get(device_id)
+            if model is None:
+                return rows,None
+            try:
+                X=model_utils.featureInput(model,df,self.dependent_variables,rows=rows)
+                return rows,model_utils.predictChunked(model,X,self.chunk_size,chunk_workers,logger=logger)
+            except Exception as exc:
+                logger.error(f"Could not predict device {device_id} with model {self.model_path.format(deviceid=device_id)}: {exc}")
+                return rows,None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,self.n_workers or 1)) as pool:
+            results=list(pool.map(lambda g: predictGroup(*g),groups.items()))
+
+        # Keep the predictions dtype when all devices agree, devices without model get NaN
+        dtypes={p.dtype for _,p in results if p is not None}
+        failed=any(p is None for _,p in results)
+        if len(dtypes)==1 and not failed:
+            dtype=dtypes.pop()
+        elif all(np.issubdtype(d,np.number) for d in dtypes):
+            dtype=np.float64
+        else:
+            dtype=object
+        predicted=np.empty(len(df),dtype=dtype) if not failed else np.full(len(df),np.nan,dtype=dtype)
+        for rows,p in results:
+            if p is not None:
+                predicted[rows]=p
+        return predicted
+
+    def predict(self, model, df):
+        """ Predict df rows, returns the array of predictions """
+        X=model_utils.featureInput(model,df,self.dependent_variables)
+        logger.info(f"Model predict() on {X.shape[0]} rows and {X.shape[1]} {'DataFrame' if hasattr(X,'columns') else X.dtype} columns, original: {df.columns}")
+        return model_utils.predictChunked(model,X,self.chunk_size,self.n_workers,logger=logger)
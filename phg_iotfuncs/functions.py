@@ -14,6 +14,7 @@
 # *****************************************************************************
 
 import os, io, json, importlib, fnmatch
+import urllib.parse
 import datetime as dt
 import math
 import logging
@@ -25,6 +26,8 @@ from sqlalchemy.sql.sqltypes import TIMESTAMP, VARCHAR
 from iotfunctions.base import BaseTransformer, BaseDataSource, BasePreload
 from iotfunctions import ui
 
+from phg_iotfuncs import iotf_utils, json_utils
+
 logger = logging.getLogger(__name__)
 
 # Specify the URL to your package here.
@@ -83,6 +86,61 @@ class HelloWorldPhG(BaseTransformer):
             ui.UIFunctionOutSingle(name='greeting_col', datatype=str, description='Output item produced by function')]
         return (inputs, outputs)
 
+def syntheticChunks(rows, entities, freq='1min', end=None, metrics=(), dates=(), categoricals=(), distributions=None,
+                    categories=('A', 'B', 'C'), chunk_rows=100000, id_column='deviceid', seed=None):
+    """
+    Generate synthetic time series as frames of at most chunk_rows rows.
+    rows are spread over the entities (a count or a list of ids), one row per entity every freq,
+    the last step at end (now by default). Rows are in time order.
+    distributions maps metric names to a numpy Generator method name and its arguments,
+    e.g. {'temp': {'dist': 'normal', 'loc': 20, 'scale': 2}}; metrics default to normal(0, 1).
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.asarray([f"entity{i + 1}" for i in range(entities)] if isinstance(entities, int) else list(entities))
+    if len(ids) == 0:
+        raise ValueError(f"At least one entity is required to generate synthetic data, got entities={entities!r}")
+    distributions = distributions or {}
+    step = pd.Timedelta(freq).value
+    steps = -(-rows // len(ids))
+    end = pd.Timestamp(end if end is not None else dt.datetime.utcnow()).value
+    start = end - (steps - 1) * step
+
+    for lo in range(0, rows, chunk_rows):
+        r = np.arange(lo, min(lo + chunk_rows, rows))
+        ts = pd.to_datetime(start + (r // len(ids)) * step)
+        data = {id_column: ids[r % len(ids)]}
+        for d in dates:
+            data[d] = ts
+        for m in metrics:
+            args = dict(distributions.get(m, {}))
+            dist = getattr(rng, args.pop('dist', 'normal'))
+            data[m] = dist(size=len(r), **args)
+        for c in categoricals:
+            if c != id_column:
+                data[c] = rng.choice(categories, len(r))
+        yield pd.DataFrame(data)
+
+# Settings of syntheticChunks which can be given in the HTTPPreload internal_test body
+SYNTHETIC_SETTINGS = ('rows', 'entities', 'freq', 'end', 'distributions', 'categories', 'chunk_rows', 'seed')
+
+# ETag and Last-Modified of the last load of each HTTPPreload request
+_httpValidators={}
+
+def nextLink(link_header):
+    ''' URL of the rel="next" entry of a Link header, None if absent '''
+    import re
+    if not link_header:
+        return None
+    m = re.search(r'<([^>]*)>\s*;[^,]*rel="?next"?', link_header)
+    return m.group(1) if m else None
+
+def withQueryParam(url, name, value):
+    ''' Set a query parameter of url '''
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if k != name]
+    query.append((name, str(value)))
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
 class HTTPPreload(BasePreload):
     """
     HTTPPreload
@@ -92,7 +150,18 @@ class HTTPPreload(BasePreload):
 
     out_table_name = None
 
-    def __init__(self, request, url, headers=None, body=None, column_map=None, output_item='http_preload_done'):
+    # Pagination, one of None (single request), 'link' (follow the Link rel="next" header),
+    # 'cursor' (cursor_field of each page sent back as the cursor_param query parameter)
+    # or 'page' (numbered pages in the page_param query parameter, fetched concurrently)
+    cursor_field = 'next'
+    cursor_param = 'cursor'
+    page_param = 'page'
+    max_concurrent_pages = 4
+    max_pages = 1000
+    # Records framed and written at once when streaming responses with a records_path
+    batch_rows = 50000
+
+    def __init__(self, request, url, headers=None, body=None, column_map=None, output_item='http_preload_done', pagination=None, records_path=None):
 
         if body is None:
             body = {}
@@ -112,6 +181,9 @@ class HTTPPreload(BasePreload):
         self.headers = headers
         self.body = body
         self.column_map = column_map
+        self.pagination = pagination
+        # Dotted path to the array of records in each response, streamed; the whole response when None
+        self.records_path = records_path
 
         # do not do any processing in the init() method. Processing will be done in the execute() method.
 
@@ -132,35 +204,152 @@ class HTTPPreload(BasePreload):
             table = self.out_table_name
 
         schema = entity_type._db_schema
+        required_cols = db.get_column_names(table=table, schema=schema)
 
         # There is a a special test "url" called internal_test
-        # Create a dict containing random data when using this
+        # Generate synthetic data when using this, configured by body keys rows, entities, freq, end,
+        # distributions, categories, chunk_rows and seed (see syntheticChunks)
         if self.url == 'internal_test':
-            rows = 3
-            response_data = {}
             (metrics, dates, categoricals, others) = db.get_column_lists_by_type(table=table, schema=schema,
                                                                                  exclude_cols=[])
-            for m in metrics:
-                response_data[m] = np.random.normal(0, 1, rows)
-            for d in dates:
-                response_data[d] = dt.datetime.utcnow() - dt.timedelta(seconds=15)
-            for c in categoricals:
-                response_data[c] = np.random.choice(['A', 'B', 'C'], rows)
-
-        # make an http request
-        else:
-            response = db.http.request(self.request, self.url, body=encoded_body, headers=self.headers)
-            response_data = response.data.decode('utf-8')
-            response_data = json.loads(response_data)
+            ignored = [k for k in self.body if k not in SYNTHETIC_SETTINGS]
+            if len(ignored) > 0:
+                logger.warning(f"Ignoring body keys {ignored}, synthetic data settings are {SYNTHETIC_SETTINGS}")
+            config = {'rows': 3, 'entities': 1, **{k: v for k, v in self.body.items() if k in SYNTHETIC_SETTINGS}}
+            t0 = dt.datetime.utcnow()
+            rows = 0
+            for df in syntheticChunks(metrics=metrics, dates=dates, categoricals=categoricals,
+                                      id_column=getattr(entity_type, '_entity_id', 'deviceid'), **config):
+                rows += self.storeFrame(entity_type, table, schema, required_cols, df)
+            elapsed = (dt.datetime.utcnow() - t0).total_seconds()
+            logger.info(f"Wrote {rows} synthetic rows in {elapsed:.1f}s, {rows / max(elapsed, 1e-6):.0f} rows/s")
+            return True
+
+        # make an http request, conditional on the validators of the previous successful load
+        key = (self.request, self.url, encoded_body)
+        headers = dict(self.headers)
+        etag, last_modified = _httpValidators.get(key, (None, None))
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+
+        response = db.http.request(self.request, self.url, body=encoded_body, headers=headers, preload_content=False)
+        if response.status == 304:
+            response.release_conn()
+            logger.info(f"{self.url} not modified since the last load")
+            entity_type.trace_append(created_by=self, msg='http data not modified', log_method=logger.debug)
+            return True
 
-        df = pd.DataFrame(data=response_data)
+        # each page is written as soon as it is received
+        pages = rows = 0
+        try:
+            for df in self.pages(db, response, encoded_body):
+                rows += self.storeFrame(entity_type, table, schema, required_cols, df)
+                pages += 1
+        except (IOError, ValueError) as exc:
+            # Error status, or body which cannot be parsed as expected
+            logger.error(f"Stopped loading {self.url} after {rows} rows: {exc}")
+            entity_type.trace_append(created_by=self, msg=f'http request failed: {exc}', log_method=logger.debug)
+            return False
+        logger.info(f"Wrote {rows} rows from {pages} pages of {self.url}")
 
-        # align dataframe with data received
+        if response.headers.get('ETag') is not None or response.headers.get('Last-Modified') is not None:
+            _httpValidators[key] = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
 
+        return True
+
+    def frames(self, response):
+        """
+        Generate the frames of the records of a response, returns the decoded fields of the response.
+        With a records_path, the body is parsed as it is received and records are framed
+        batch_rows at a time, the other fields of the response are its top-level scalars.
+        Raises IOError when the response status is not 2xx, ValueError when the body cannot be parsed.
+        """
+        try:
+            if not 200 <= response.status < 300:
+                raise IOError(f"HTTP status {response.status} {getattr(response, 'reason', '')}".rstrip())
+            if self.records_path:
+                path = self.records_path if self.records_path.endswith('[]') else self.records_path + '[]'
+                parser = json_utils.ItemParser(response.stream(1 << 16), path)
+                batch = []
+                for _, record in parser:
+                    batch.append(record)
+                    if len(batch) >= self.batch_rows:
+                        yield pd.DataFrame.from_records(batch)
+                        batch = []
+                if len(batch) > 0:
+                    yield pd.DataFrame.from_records(batch)
+                return parser.fields
+            else:
+                payload = json.loads(response.data.decode('utf-8'))
+                yield pd.DataFrame(data=payload)
+                return payload
+        finally:
+            response.release_conn()
+
+    def pages(self, db, response, encoded_body):
+        """
+        Generate the frames of all pages, following the pagination from the first response.
+        Pooled connections of db.http are reused for all pages.
+        """
+        fetch = lambda url: db.http.request(self.request, url, body=encoded_body, headers=self.headers, preload_content=False)
+        if self.pagination == 'page':
+            yield from self.numberedPages(response, fetch)
+            return
+
+        payload = yield from self.frames(response)
+        if self.pagination == 'link':
+            for _ in range(self.max_pages - 1):
+                url = nextLink(response.headers.get('Link'))
+                if url is None:
+                    break
+                response = fetch(urllib.parse.urljoin(self.url, url))
+                payload = yield from self.frames(response)
+        elif self.pagination == 'cursor':
+            for _ in range(self.max_pages - 1):
+                cursor = payload.get(self.cursor_field) if isinstance(payload, dict) else None
+                if not cursor:
+                    break
+                payload = yield from self.frames(fetch(withQueryParam(self.url, self.cursor_param, cursor)))
+
+    def numberedPages(self, response, fetch):
+        """
+        Generate the frames of numbered pages, from the first page response, until an empty page.
+        Following pages are fetched max_concurrent_pages at a time.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        rows = 0
+        for df in self.frames(response):
+            rows += len(df.index)
+            if len(df.index) > 0:
+                yield df
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_pages) as pool:
+            page = 2
+            while rows > 0 and page <= self.max_pages:
+                wave = range(page, min(page + self.max_concurrent_pages, self.max_pages + 1))
+                responses = list(pool.map(lambda n: fetch(withQueryParam(self.url, self.page_param, n)), wave))
+                try:
+                    for response in responses:
+                        if rows == 0:
+                            break
+                        rows = 0
+                        for df in self.frames(response):
+                            rows += len(df.index)
+                            if len(df.index) > 0:
+                                yield df
+                finally:
+                    # Pages after the last one, or after an error
+                    for response in responses:
+                        response.release_conn()
+                page += len(wave)
+
+    def storeFrame(self, entity_type, table, schema, required_cols, df):
+        ''' Align a frame of received data on the table columns and write it, return the number of rows '''
         # use supplied column map to rename columns
         df = df.rename(self.column_map, axis='columns')
         # fill in missing columns with nulls
-        required_cols = db.get_column_names(table=table, schema=schema)
         missing_cols = list(set(required_cols) - set(df.columns))
         if len(missing_cols) > 0:
             kwargs = {'missing_cols': missing_cols}
@@ -181,8 +370,7 @@ class HTTPPreload(BasePreload):
         self.write_frame(df=df, table_name=table)
         kwargs = {'table_name': table, 'schema': schema, 'row_count': len(df.index)}
         entity_type.trace_append(created_by=self, msg='Wrote data to table', log_method=logger.debug, **kwargs)
-
-        return True
+        return len(df.index)
 
     @classmethod
     def build_ui(cls):
@@ -195,12 +383,86 @@ class HTTPPreload(BasePreload):
                                   values=['GET', 'POST', 'PUT', 'DELETE']))
         inputs.append(ui.UISingle(name='url', datatype=str, description='request url', tags=['TEXT'], required=True))
         inputs.append(ui.UISingle(name='headers', datatype=dict, description='request url', required=False))
-        inputs.append(ui.UISingle(name='body', datatype=dict, description='request body', required=False))
+        inputs.append(ui.UISingle(name='body', datatype=dict, description='request body, or synthetic data settings when url is internal_test', required=False))
+        inputs.append(ui.UISingle(name='pagination', datatype=str, description='Pagination of the responses', values=['link', 'cursor', 'page'], required=False))
+        inputs.append(ui.UISingle(name='records_path', datatype=str, description="Dotted path of the array of records in the response, parsed as received, '[]' when the response is the array", required=False))
         # define arguments that behave as function outputs
         outputs = []
         outputs.append(ui.UIStatusFlag(name='output_item'))
         return (inputs, outputs)
 
+def mergeNearest(left_ids, left_ts, right, right_id, right_ts, columns, tolerance=None, direction='nearest',
+                 chunk_rows=1000000, n_workers=None):
+    """
+    As-of join of the right columns on left rows: for each left (id, timestamp), the row of right with
+    the same id and the closest timestamp in direction ('backward', 'forward' or 'nearest'),
+    within tolerance. Returns a dict of the column arrays aligned on the left rows, missing where there
+    is no match.
+
+    Right rows are sorted once on (id, timestamp) into a single int64 key, then left rows are matched
+    by binary search in chunks of chunk_rows, on n_workers threads.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    lts = pd.to_datetime(np.asarray(left_ts)).values.astype('datetime64[ns]').view('i8')
+    if len(right.index) == 0:
+        pos = np.full(len(lts), -1, dtype=np.intp)
+        order = np.arange(0)
+    else:
+        rcodes, uniques = pd.factorize(right[right_id])
+        # Left ids are mapped to right codes through their distinct values
+        lcodes, luniques = pd.factorize(left_ids)
+        lcodes = np.append(pd.Index(uniques).get_indexer(luniques), -1)[lcodes]
+        rts = right[right_ts].to_numpy(dtype='datetime64[ns]').view('i8')
+        order = np.lexsort((rts, rcodes))
+        rcodes = rcodes[order]
+        rts = rts[order]
+        # Key of each right row: entity code then rank of its timestamp
+        times = np.unique(rts)
+        width = len(times) + 1
+        rkey = rcodes.astype(np.int64) * width + np.searchsorted(times, rts)
+        last = len(rkey) - 1
+        tol = None if tolerance is None else pd.Timedelta(tolerance).value
+        pos = np.empty(len(lts), dtype=np.intp)
+
+        def match(lo, hi):
+            c = lcodes[lo:hi]
+            t = lts[lo:hi]
+            base = c.astype(np.int64) * width
+            # last right row at or before t, first right row at or after t, in the same entity
+            b = np.searchsorted(rkey, base + np.searchsorted(times, t, 'right') - 1, 'right') - 1
+            f = np.searchsorted(rkey, base + np.searchsorted(times, t, 'left'), 'left')
+            b_ok = (b >= 0) & (rcodes[np.maximum(b, 0)] == c)
+            f_ok = (f <= last) & (rcodes[np.minimum(f, last)] == c)
+            b_dist = np.where(b_ok, t - rts[np.maximum(b, 0)], np.iinfo(np.int64).max)
+            f_dist = np.where(f_ok, rts[np.minimum(f, last)] - t, np.iinfo(np.int64).max)
+            if direction == 'backward':
+                p, dist = np.where(b_ok, b, -1), b_dist
+            elif direction == 'forward':
+                p, dist = np.where(f_ok, f, -1), f_dist
+            else:
+                # ties go backward, as merge_asof does
+                use_f = f_dist < b_dist
+                p = np.where(use_f, f, np.where(b_ok, b, -1))
+                dist = np.minimum(b_dist, f_dist)
+            if tol is not None:
+                p[dist > tol] = -1
+            p[c < 0] = -1
+            pos[lo:hi] = p
+
+        bounds = [(lo, min(lo + chunk_rows, len(lts))) for lo in range(0, len(lts), chunk_rows)]
+        if len(bounds) > 1:
+            with ThreadPoolExecutor(max_workers=n_workers or min(4, os.cpu_count() or 1)) as pool:
+                list(pool.map(lambda b: match(*b), bounds))
+        else:
+            for b in bounds:
+                match(*b)
+
+    return {c: pd.api.extensions.take(right[c].to_numpy()[order], pos, allow_fill=True) for c in columns}
+
+# Last sample generation check of each MergeSampleTimeSeries source table
+_sampleChecks = {}
+
 class MergeSampleTimeSeries(BaseDataSource):
     """
     MergeSampleTimeSeries
@@ -221,22 +483,55 @@ class MergeSampleTimeSeries(BaseDataSource):
     sample_initial_days = 3
     sample_freq = '1min'
     sample_incremental_min = 5
+    # nearest merge engine: rows matched per chunk and threads (see mergeNearest)
+    merge_chunk_rows = 1000000
+    merge_workers = None
 
     def __init__(self, input_items, output_items=None):
         super().__init__(input_items=input_items, output_items=output_items)
 
+    def execute(self, df, start_ts=None, end_ts=None, entities=None):
+        if self.merge_method != 'nearest':
+            return super().execute(df, start_ts=start_ts, end_ts=end_ts, entities=entities)
+
+        # Source rows up to the tolerance outside the window can be the nearest
+        tolerance = self.merge_nearest_tolerance
+        new_df = self.get_data(start_ts=None if start_ts is None or tolerance is None else start_ts - tolerance,
+                               end_ts=None if end_ts is None or tolerance is None else end_ts + tolerance,
+                               entities=entities)
+
+        # Entity frames are indexed on (id, timestamp)
+        df = df.copy()
+        merged = mergeNearest(df.index.get_level_values(0), df.index.get_level_values(1), new_df,
+                              self.source_entity_id, self._entity_type._timestamp, list(self.input_items),
+                              tolerance=tolerance, direction=self.merge_nearest_direction,
+                              chunk_rows=self.merge_chunk_rows, n_workers=self.merge_workers)
+        for item, output in zip(self.input_items, self.output_items or self.input_items):
+            df[output] = merged[item]
+        return df
+
     def get_data(self, start_ts=None, end_ts=None, entities=None):
 
-        self.load_sample_data()
-        (query, table) = self._entity_type.db.query(self.source_table_name, schema=self._entity_type._db_schema)
+        # Sample generation is only checked every sample_incremental_min, not on each read
+        key = (self._entity_type._db_schema, self.source_table_name)
+        now = dt.datetime.utcnow()
+        if key not in _sampleChecks or now - _sampleChecks[key] >= dt.timedelta(minutes=self.sample_incremental_min):
+            self.load_sample_data()
+            _sampleChecks[key] = now
+
+        # Only read the requested items with the key columns
+        timestamp = self._entity_type._timestamp
+        column_names = list(dict.fromkeys([self.source_entity_id, timestamp] + list(self.input_items)))
+        (query, table) = self._entity_type.db.query(self.source_table_name, schema=self._entity_type._db_schema,
+                                                    column_names=column_names)
         if not start_ts is None:
-            query = query.filter(table.c[self._entity_type._timestamp] >= start_ts)
+            query = query.filter(table.c[timestamp] >= start_ts)
         if not end_ts is None:
-            query = query.filter(table.c[self._entity_type._timestamp] < end_ts)
+            query = query.filter(table.c[timestamp] < end_ts)
         if not entities is None:
-            query = query.filter(table.c.deviceid.in_(entities))
+            query = query.filter(table.c[self.source_entity_id].in_(entities))
 
-        parse_dates = [self._entity_type._timestamp]
+        parse_dates = [timestamp]
         df = self._entity_type.db.read_sql_query(query.statement, parse_dates=parse_dates)
 
         return df
@@ -255,27 +550,44 @@ class MergeSampleTimeSeries(BaseDataSource):
             raise NotImplementedError(msg)
 
     def load_sample_data(self):
-
-        if not self._entity_type.db.if_exists(self.source_table_name):
-            generator = TimeSeriesGenerator(metrics=self.sample_metrics, ids=self.sample_entities,
-                                            freq=self.sample_freq, days=self.sample_initial_days,
-                                            timestamp=self._entity_type._timestamp)
-        else:
-            generator = TimeSeriesGenerator(metrics=self.sample_metrics, ids=self.sample_entities,
-                                            freq=self.sample_freq, seconds=self.sample_incremental_min * 60,
-                                            timestamp=self._entity_type._timestamp)
-
-        df = generator.execute()
-        self._entity_type.db.write_frame(df=df, table_name=self.source_table_name, version_db_writes=False,
-                                         if_exists='append', schema=self._entity_type._db_schema,
-                                         timestamp_col=self._entity_type._timestamp_col)
+        """
+        Append the sample rows missing between the latest timestamp of the sample table and now,
+        on the sample_freq grid. Generating again before the next step writes nothing.
+        """
+        db = self._entity_type.db
+        schema = self._entity_type._db_schema
+        timestamp = self._entity_type._timestamp
+        step = pd.Timedelta(self.sample_freq)
+        end = pd.Timestamp(dt.datetime.utcnow()).floor(step)
+        # Catch up at most sample_initial_days
+        start = end - pd.Timedelta(days=self.sample_initial_days) + step
+
+        if db.if_exists(self.source_table_name, schema=schema):
+            from sqlalchemy import func
+            (query, table) = db.query(self.source_table_name, schema=schema)
+            latest = query.with_entities(func.max(table.c[timestamp])).scalar()
+            if latest is not None:
+                start = max(start, pd.Timestamp(latest).floor(step) + step)
+
+        steps = (end - start) // step + 1
+        if steps <= 0:
+            logger.debug(f"Sample data of {self.source_table_name} is up to date")
+            return
+
+        rows = 0
+        for df in syntheticChunks(steps * len(self.sample_entities), self.sample_entities, freq=step, end=end,
+                                  metrics=self.sample_metrics, dates=[timestamp], id_column=self.source_entity_id):
+            db.write_frame(df=df, table_name=self.source_table_name, version_db_writes=False,
+                           if_exists='append', schema=schema, timestamp_col=self._entity_type._timestamp_col)
+            rows += len(df.index)
+        logger.info(f"Appended {rows} sample rows from {start} to {end} to {self.source_table_name}")
 
     def get_test_data(self):
 
-        generator = TimeSeriesGenerator(metrics=['acceleration'], ids=self.sample_entities, freq=self.sample_freq,
-                                        seconds=300, timestamp=self._entity_type._timestamp)
-
-        df = generator.execute()
+        step = pd.Timedelta(self.sample_freq)
+        df = pd.concat(syntheticChunks(max(int(pd.Timedelta(seconds=300) / step), 1) * len(self.sample_entities),
+                                       self.sample_entities, freq=step, metrics=['acceleration'],
+                                       dates=[self._entity_type._timestamp], id_column=self.source_entity_id))
         df = self._entity_type.index_df(df)
         return df
 
@@ -290,6 +602,15 @@ class MergeSampleTimeSeries(BaseDataSource):
         # outputs are included as an empty list as they are derived from inputs
         return (inputs, [])
 
+def concatDeviceFrames(frames,device_ids):
+    """
+    Concatenate the per-device frames in a single copy, adding the device id
+    as the 'id' column
+    """
+    df=pd.concat(frames,ignore_index=True) if len(frames)>1 else frames[0].copy()
+    df['id']=np.repeat(device_ids,[len(f.index) for f in frames])
+    return df
+
 class CSVDataSource(BaseDataSource):
     """
     CSVDataSource
@@ -302,6 +623,10 @@ class CSVDataSource(BaseDataSource):
     merge_method = 'outer'
     allow_projection_list_trim = False
 
+    # Threads loading the matching CSV files, and MB of files loaded at once (unbounded when None)
+    load_workers = None
+    memory_budget_mb = None
+
 #     def __init__(self, csv_file, input_items, output_items=None):
     def __init__(self, input_items,output_items):
         #warnings.warn('GetEntityData is deprecated.', DeprecationWarning)
@@ -326,24 +651,33 @@ class CSVDataSource(BaseDataSource):
             logger.error(f"All files in {module_path}:",allfiles)
             df=None
         else:
-            df=pd.read_csv(os.path.join(module_path,csv_files[0]))
-            logger.info(f"Loaded df=",df.dtypes,df)
-            df['Date']=pd.to_datetime(df['Date'])
+            # One file per device, named after the device id
+            device_ids=[f.split('.')[0] for f in csv_files]
+            paths=[os.path.join(module_path,f) for f,d in zip(csv_files,device_ids) if entities is None or d in entities]
+            device_ids=[d for d in device_ids if entities is None or d in entities]
+            if len(paths)==0:
+                paths,device_ids=[os.path.join(module_path,csv_files[0])],[csv_files[0].split('.')[0]]
+                entities_empty=True
+            else:
+                entities_empty=False
+
+            # Push the entity and time range filters down, only the requested windows are copied
+            def load(path):
+                sorted_df=iotf_utils.getSortedCSV(path,'Date',logger=logger)
+                return sorted_df.iloc[0:0] if entities_empty else iotf_utils.sliceTimeRange(sorted_df,'Date',start_ts,end_ts)
+            frames=iotf_utils.loadFilesParallel(paths,load,self.load_workers,self.memory_budget_mb,logger=logger)
+            df=concatDeviceFrames(frames,device_ids)
+            logger.info(f"Loaded {len(df.index)} rows from {len(paths)} files")
 
             # Adjust columns, add evt_timestamp, deviceid
-            df['id']=csv_files[0].split('.')[0]
             df.rename(columns={'Date':'evt_timestamp'},inplace=True)
             df.set_index(['id','evt_timestamp'],drop=False,inplace=True)
             df.rename(columns={'id':'deviceid','evt_timestamp':'_timestamp'},inplace=True)
-            logger.info(f"New df=",df.dtypes,df)
+            logger.debug(f"New df={df.dtypes}")
 
         return df
 
-    @classmethod
-    def get_module_files(cls,pattern):
-        module_path=os.path.dirname(importlib.import_module(cls.__module__).__file__)
-        logger.debug(f"module_path={module_path}")
-        return [f for f in os.listdir(module_path) if fnmatch.fnmatch(f,pattern)],module_path
+    get_module_files = classmethod(iotf_utils.moduleFiles)
 
     @classmethod
     def build_ui(cls):
@@ -369,21 +703,24 @@ class CSVPreload(BasePreload):
 
     out_table_name = None
 
-    def __init__(self, csv_file, rebaseTS, output_item='csv_preload_done'):
+    # Threads loading the matching CSV files, and MB of files loaded at once (unbounded when None)
+    load_workers = None
+    memory_budget_mb = None
+
+    def __init__(self, csv_file, rebaseTS, output_item='csv_preload_done', incremental_rows=None, offset_constant=None):
         super().__init__(dummy_items=[], output_item=output_item)
 
         # create an instance variable with the same name as each arg
 
         self.csv_file = csv_file
         self.rebaseTS = rebaseTS
+        # When set, only load the next incremental_rows rows at each run, tracking the offset in a constant
+        self.incremental_rows = incremental_rows
+        self.offset_constant = offset_constant
 
         # do not do any processing in the init() method. Processing will be done in the execute() method.
 
-    @classmethod
-    def get_module_files(cls,pattern):
-        module_path=os.path.dirname(importlib.import_module(cls.__module__).__file__)
-        logger.debug(f"module_path={module_path}")
-        return [f for f in os.listdir(module_path) if fnmatch.fnmatch(f,pattern)],module_path
+    get_module_files = classmethod(iotf_utils.moduleFiles)
 
     def execute(self, df, start_ts=None, end_ts=None, entities=None):
         entity_type = self.get_entity_type()
@@ -413,20 +750,37 @@ class CSVPreload(BasePreload):
             return False
 
         else:
-            logger.info(f"Reading CSV file {csv_files[0]}")
-            df=pd.read_csv(os.path.join(module_path,csv_files[0]))
-
-            # Adjust date
-            df['Date']=pd.to_datetime(df['Date'])
-
-            # Adjust timestamp
-            if self.rebaseTS:
+            logger.info(f"Reading CSV files {csv_files}")
+            # One file per device, named after the device id
+            device_ids=[f.split('.')[0] for f in csv_files]
+            paths=[os.path.join(module_path,f) for f in csv_files]
+            if self.incremental_rows:
+                # Only the next slice of each file, the offset is stored once the slices are written
+                offset_constant=self.offset_constant or f"csv_offset_{entity_type.name}".lower()
+                offset=iotf_utils.getConstant(db,offset_constant,0,auto_register=True,const_type=int)
+                load=lambda path: self.readSlice(path,offset)
+                # Wrapped on a common multiple of the files row counts, where all files are back at their first row
+                period=1
+                for count in [max(iotf_utils.csvRowCount(p),1) for p in paths]:
+                    period=period*count//math.gcd(period,count)
+                next_offset=(offset+int(self.incremental_rows))%period
+            else:
+                # Parsed once, then loaded typed from the columnar cache
+                load=lambda path: iotf_utils.readPackagedCSV(path,parse_dates=['Date'],logger=logger)
+            frames=iotf_utils.loadFilesParallel(paths,load,self.load_workers,self.memory_budget_mb,logger=logger)
+            df=concatDeviceFrames(frames,device_ids)
+
+            # Adjust timestamp, all devices are shifted together, or each device slice on its own
+            if self.rebaseTS and self.incremental_rows:
+                deltaTS=dt.datetime.utcnow()-df.groupby('id',sort=False)['Date'].transform('max')
+                logger.info(f"Rebasing timestamps of each device slice to end now")
+                df['Date']=deltaTS+df['Date']
+            elif self.rebaseTS:
                 deltaTS=dt.datetime.utcnow()-df['Date'].max()
                 logger.info(f"Rebasing timestamp to delta {deltaTS}")
                 df['Date']=deltaTS+df['Date']
 
             # Adjust columns, add evt_timestamp, deviceid
-            df['id']=csv_files[0].split('.')[0]
             df.rename(columns={'Date':'evt_timestamp'},inplace=True)
             df.set_index(['id','evt_timestamp'],drop=False,inplace=True)
             df.rename(columns={'id':'deviceid','evt_timestamp':'_timestamp'},inplace=True)
@@ -465,8 +819,43 @@ class CSVPreload(BasePreload):
             kwargs = {'table_name': table, 'schema': schema, 'row_count': len(df.index)}
             entity_type.trace_append(created_by=self, msg='Wrote data to table', log_method=logger.debug, **kwargs)
 
+            if self.incremental_rows:
+                iotf_utils.putConstant(db,offset_constant,next_offset)
+                logger.info(f"Updated constant {offset_constant} to row offset {next_offset}")
+
             return True
 
+    def readSlice(self,csv_path,offset):
+        """
+        Read the incremental_rows data rows following offset. Each file cycles
+        on its own length, so replay files of different lengths keep streaming:
+        a slice reaching the end of file is completed from its first rows.
+        When rebasing timestamps, rows of each later cycle through the file are moved
+        forward by the file time span, so that the slice timestamps stay continuous.
+        """
+        import pandas as pd
+
+        total=iotf_utils.csvRowCount(csv_path)
+        if total==0:
+            return pd.read_csv(csv_path,parse_dates=['Date'])
+        start=offset%total
+        nrows=min(int(self.incremental_rows),total)
+        # Keep the header line, skip the rows already loaded
+        df=pd.read_csv(csv_path,skiprows=range(1,start+1),nrows=nrows,parse_dates=['Date'])
+        cycles=np.full(len(df.index),offset//total)
+        if len(df.index)<nrows:
+            logger.info(f"End of {csv_path} reached, continuing at row 0")
+            head=pd.read_csv(csv_path,nrows=nrows-len(df.index),parse_dates=['Date'])
+            cycles=np.concatenate([cycles,np.full(len(head.index),offset//total+1)])
+            df=pd.concat([df,head],ignore_index=True)
+        if self.rebaseTS:
+            # One cycle lasts the file time span plus the mean interval between its rows
+            first,last=iotf_utils.csvTimeRange(csv_path,'Date')
+            period=(last-first)*total/(total-1) if total>1 else pd.Timedelta(0)
+            df['Date']=df['Date']+pd.to_timedelta(cycles*period.value,unit='ns')
+        logger.info(f"Read {len(df.index)} rows from row {start} of {csv_path}")
+        return df
+
     @classmethod
     def build_ui(cls):
         """
@@ -476,6 +865,8 @@ class CSVPreload(BasePreload):
         inputs = []
         inputs.append(ui.UISingle(name='csv_file', datatype=str, description='CSV File pattern (*.csv)', tags=['TEXT'], required=True))
         inputs.append(ui.UISingle(name='rebaseTS', datatype=bool, description='Rebase timestamps', required=True))
+        inputs.append(ui.UISingle(name='incremental_rows', datatype=int, description='Number of rows loaded at each run, the whole file when empty', required=False))
+        inputs.append(ui.UISingle(name='offset_constant', datatype=str, description='Name of the constant holding the row offset, defaults to csv_offset_<entity type>', required=False))
         # define arguments that behave as function outputs
         outputs = []
         outputs.append(ui.UIStatusFlag(name='output_item'))
@@ -160,4 +160,304 @@ def adjustDataFrameColumns(db,entity_meta_dict,df,eventType,force_upper_columns,
 
     logger.info(f"df columns final={[c for c in df.columns]}")
 
-    return
\ No newline at end of file
+    return
+class EntityWindowCache:
+    """
+    Process-wide incremental cache of the recent data window of an entity type.
+    Each getData() call only reads [last_read-overlap, end_ts) from the database,
+    merges it on the (id,timestamp) index and evicts data older than start_ts.
+    The whole window is read again when start_ts is older than the cached window.
+    The returned DataFrame is shared with the cache and must not be modified in place.
+    """
+    def __init__(self,name,overlap_seconds=0):
+        self.name=name
+        self.overlap=dt.timedelta(seconds=overlap_seconds)
+        self.df=None
+        self.columns=None
+        self.last_read=None
+        # Oldest timestamp covered by the cached rows, newer rows were evicted
+        self.first_ts=None
+        # Set when the entity type does not accept a columns projection
+        self.no_projection=False
+
+    def getData(self,entity_type,start_ts,end_ts,columns=None,logger=logger):
+        if self.no_projection:
+            columns=None
+        if self.df is None or self.last_read is None or self.last_read-self.overlap<start_ts or columns!=self.columns \
+                or self.first_ts is None or start_ts<self.first_ts:
+            fetch_ts=start_ts
+            self.df=None
+        else:
+            fetch_ts=self.last_read-self.overlap
+
+        try:
+            dfRead=entity_type.get_data(start_ts=fetch_ts,end_ts=end_ts,entities=None,columns=columns)
+        except Exception as exc:
+            if columns is None:
+                raise
+            logger.warning(f"Cache {self.name} could not read columns {columns}, reading all columns: {exc}")
+            columns=None
+            self.no_projection=True
+            self.df=None
+            fetch_ts=start_ts
+            dfRead=entity_type.get_data(start_ts=fetch_ts,end_ts=end_ts,entities=None,columns=None)
+        logger.info(f"Cache {self.name} read {len(dfRead)} rows from {fetch_ts} to {end_ts}")
+
+        self.columns=columns
+        self.last_read=end_ts
+        if self.df is None:
+            self.first_ts=fetch_ts
+        self.merge(dfRead)
+        self.evict(start_ts)
+        return self.df
+
+    def project(self,columns):
+        ''' Keep only columns in the cache, later reads will only request these columns '''
+        if self.df is not None:
+            self.df=self.df[columns]
+        if not self.no_projection:
+            self.columns=columns
+
+    def merge(self,dfNew):
+        ''' Merge rows into the cache, new rows replace cached rows with the same index '''
+        import pandas as pd
+        if self.df is None or len(self.df)==0:
+            self.df=dfNew
+        elif len(dfNew)>0:
+            df=pd.concat([self.df,dfNew],axis=0)
+            self.df=df[~df.index.duplicated(keep='last')].sort_index()
+
+    def evict(self,start_ts):
+        ''' Drop cached rows with timestamps older than start_ts '''
+        if self.df is not None and len(self.df)>0:
+            self.df=self.df[self.df.index.get_level_values(1)>=start_ts]
+        if self.first_ts is None or self.first_ts<start_ts:
+            self.first_ts=start_ts
+
+# Caches by (name,window), kept for the lifetime of the pipeline process
+_windowCaches={}
+
+def getWindowCache(name,overlap_seconds=0,window=None):
+    '''
+    Get or create the named process-wide EntityWindowCache.
+    Callers reading windows of different lengths get separate caches, so that
+    the shorter window does not evict rows the longer one needs
+    '''
+    key=(name,window)
+    if key not in _windowCaches:
+        _windowCaches[key]=EntityWindowCache(name,overlap_seconds)
+    return _windowCaches[key]
+
+# Directory of the columnar cache of packaged CSV files, defaults to a private per-user temp directory
+ENV_CSV_CACHE_DIR='PHG_IOTFUNCS_CSV_CACHE_DIR'
+
+def _parquetEngine():
+    ''' True when a parquet engine is installed, e.g. with the phg_iotfuncs[parquet] extra '''
+    for engine in ('pyarrow','fastparquet'):
+        try:
+            importlib.import_module(engine)
+            return True
+        except ImportError:
+            pass
+    return False
+
+def _privateTempDir(name,logger=logger):
+    '''
+    Get the per-user directory name in the temp directory, created with mode 0700.
+    None when it exists but is not a directory owned by the user and private to it
+    '''
+    import tempfile, stat, getpass
+
+    uid=os.getuid() if hasattr(os,'getuid') else None
+    path=os.path.join(tempfile.gettempdir(),f"{name}-{uid if uid is not None else getpass.getuser()}")
+    try:
+        os.makedirs(path,mode=0o700,exist_ok=True)
+        st=os.lstat(path)
+    except OSError as exc:
+        logger.warning(f"Could not create {path}: {exc}")
+        return None
+    if not stat.S_ISDIR(st.st_mode) or (uid is not None and (st.st_uid!=uid or st.st_mode&0o077)):
+        logger.warning(f"Not using {path}, which is not a directory private to the current user")
+        return None
+    return path
+
+def readPackagedCSV(csv_path,parse_dates=None,cache_dir=None,logger=logger):
+    """
+    Read a CSV file shipped in the package, through a typed columnar cache.
+    The first read parses the CSV and stores it as Parquet, keyed by file size
+    and modification time. Later reads load the cached file directly.
+    Without a Parquet engine installed, the CSV is parsed on each read.
+    """
+    import pandas as pd
+
+    if not _parquetEngine():
+        logger.info(f"No parquet engine installed, parsing CSV file {csv_path}")
+        return pd.read_csv(csv_path,parse_dates=parse_dates)
+    if cache_dir is None:
+        cache_dir=os.environ.get(ENV_CSV_CACHE_DIR) or _privateTempDir('phg_iotfuncs_csv',logger=logger)
+        if cache_dir is None:
+            return pd.read_csv(csv_path,parse_dates=parse_dates)
+    st=os.stat(csv_path)
+    name=os.path.basename(csv_path)
+    cache_path=os.path.join(cache_dir,f"{name}-{st.st_size}-{st.st_mtime_ns}.parquet")
+
+    if os.path.exists(cache_path):
+        try:
+            df=pd.read_parquet(cache_path)
+            logger.info(f"Loaded {csv_path} from columnar cache {cache_path}")
+            return df
+        except Exception as exc:
+            logger.warning(f"Could not read cached {cache_path}, parsing CSV: {exc}")
+
+    logger.info(f"Parsing CSV file {csv_path}")
+    df=pd.read_csv(csv_path,parse_dates=parse_dates)
+    try:
+        os.makedirs(cache_dir,mode=0o700,exist_ok=True)
+        # Drop cached versions of previous file contents
+        for f in os.listdir(cache_dir):
+            if f.startswith(name+'-') and not f.endswith('.tmp'):
+                os.remove(os.path.join(cache_dir,f))
+        tmp=f"{cache_path}.{os.getpid()}.tmp"
+        df.to_parquet(tmp)
+        os.replace(tmp,cache_path)
+        logger.info(f"Cached {csv_path} as {cache_path}")
+    except OSError as exc:
+        logger.warning(f"Could not cache {csv_path} in {cache_dir}: {exc}")
+    return df
+
+# Process-wide cache of time sorted packaged CSV frames, by file path
+_sortedCSVs={}
+
+def getSortedCSV(csv_path,ts_column='Date',logger=logger):
+    """
+    Return the packaged CSV frame sorted on its timestamp column, built once
+    per file version and kept for the process. Callers slice it with
+    sliceTimeRange and must copy what they modify.
+    """
+    st=os.stat(csv_path)
+    version=(st.st_size,st.st_mtime_ns)
+    cached=_sortedCSVs.get(csv_path)
+    if cached is None or cached[0]!=version:
+        df=readPackagedCSV(csv_path,parse_dates=[ts_column],logger=logger)
+        df=df.sort_values(ts_column,kind='stable',ignore_index=True)
+        logger.info(f"Built sorted timestamp index of {csv_path}, {len(df.index)} rows")
+        cached=_sortedCSVs[csv_path]=(version,df)
+    return cached[1]
+
+# Process-wide cache of CSV data row counts, by file path
+_csvRowCounts={}
+
+def csvRowCount(csv_path):
+    ''' Number of data rows of a CSV file with a header line, counted once per file version '''
+    st=os.stat(csv_path)
+    version=(st.st_size,st.st_mtime_ns)
+    cached=_csvRowCounts.get(csv_path)
+    if cached is None or cached[0]!=version:
+        lines,last=0,b'\n'
+        with io.open(csv_path,'rb') as f:
+            for block in iter(lambda: f.read(1<<20),b''):
+                lines+=block.count(b'\n')
+                last=block[-1:]
+        # The last line may not end with a newline
+        if last!=b'\n':
+            lines+=1
+        cached=_csvRowCounts[csv_path]=(version,max(lines-1,0))
+    return cached[1]
+
+# Process-wide cache of CSV timestamp ranges, by file path
+_csvTimeRanges={}
+
+def csvTimeRange(csv_path,ts_column='Date'):
+    ''' (min,max) of the ts_column of a CSV file, read once per file version '''
+    import pandas as pd
+    st=os.stat(csv_path)
+    version=(st.st_size,st.st_mtime_ns,ts_column)
+    cached=_csvTimeRanges.get(csv_path)
+    if cached is None or cached[0]!=version:
+        ts=pd.read_csv(csv_path,usecols=[ts_column],parse_dates=[ts_column])[ts_column]
+        cached=_csvTimeRanges[csv_path]=(version,(ts.min(),ts.max()))
+    return cached[1]
+
+def sliceTimeRange(df,ts_column,start_ts=None,end_ts=None):
+    ''' Slice [start_ts,end_ts) of a frame sorted on ts_column by binary search, without copy '''
+    import pandas as pd
+    ts=df[ts_column]
+    lo=0 if start_ts is None else ts.searchsorted(pd.Timestamp(start_ts),side='left')
+    hi=len(ts) if end_ts is None else ts.searchsorted(pd.Timestamp(end_ts),side='left')
+    return df.iloc[lo:max(lo,hi)]
+
+def loadFilesParallel(paths,loader,max_workers=None,memory_budget_mb=None,logger=logger):
+    """
+    Call loader(path) for each path on a thread pool and return the results in
+    path order. With memory_budget_mb, files are only submitted while the total
+    size of the files being loaded stays within the budget.
+    """
+    from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
+
+    if len(paths)<=1:
+        return [loader(p) for p in paths]
+
+    sizes=[os.path.getsize(p) for p in paths]
+    budget=None if memory_budget_mb is None else memory_budget_mb*1048576
+    results=[None]*len(paths)
+    with ThreadPoolExecutor(max_workers=max_workers or min(8,len(paths))) as pool:
+        pending={}
+        inflight=0
+        for i,path in enumerate(paths):
+            # Let running loads complete while this file would exceed the budget
+            while budget is not None and pending and inflight+sizes[i]>budget:
+                done,_=wait(pending,return_when=FIRST_COMPLETED)
+                for f in done:
+                    j=pending.pop(f)
+                    inflight-=sizes[j]
+                    results[j]=f.result()
+            pending[pool.submit(loader,path)]=i
+            inflight+=sizes[i]
+        for f,j in pending.items():
+            results[j]=f.result()
+    logger.info(f"Loaded {len(paths)} files, {sum(sizes)/1048576:.1f}MB")
+    return results
+
+class ModuleFileIndex():
+    """
+    Listing of the file names of a package directory, scanned once and rescanned
+    only when the directory mtime changes, as it does when files are added,
+    removed or renamed. Patterns are compiled once.
+    """
+    def __init__(self,module_path):
+        self.module_path=module_path
+        self.dir_mtime=None
+        self.files=[]
+        self.patterns={}
+
+    def refresh(self):
+        dir_mtime=os.stat(self.module_path).st_mtime_ns
+        if dir_mtime!=self.dir_mtime:
+            with os.scandir(self.module_path) as it:
+                self.files=sorted(entry.name for entry in it)
+            self.dir_mtime=dir_mtime
+            logger.debug(f"Indexed {len(self.files)} files in {self.module_path}")
+        return self
+
+    def match(self,pattern):
+        ''' Names matching the fnmatch pattern '''
+        import re
+        regex=self.patterns.get(pattern)
+        if regex is None:
+            regex=self.patterns[pattern]=re.compile(fnmatch.translate(os.path.normcase(pattern)))
+        return [f for f in self.refresh().files if regex.match(os.path.normcase(f))]
+
+# Process-wide module file indexes, by directory
+_moduleFileIndexes={}
+
+def getModuleFileIndex(module_name):
+    module_path=os.path.dirname(importlib.import_module(module_name).__file__)
+    index=_moduleFileIndexes.get(module_path)
+    if index is None:
+        index=_moduleFileIndexes[module_path]=ModuleFileIndex(module_path)
+    return index
+
+def moduleFiles(cls,pattern):
+    ''' get_module_files implementation shared by the function classes: (matching files, module path) '''
+    index=getModuleFileIndex(cls.__module__)
+    return index.match(pattern),index.module_path
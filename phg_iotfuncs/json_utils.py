@@ -0,0 +1,152 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2021.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+# Maximo Monitor IoT Functions utilities
+#
+# Incremental JSON parsing of the records found at a known path of large
+# responses, without building the whole document in memory
+#
+# Written by Philippe Gregoire, IBM France, Hybrid CLoud Build Team Europe
+# *****************************************************************************
+
+import json, codecs
+import logging
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE=' \t\n\r'
+_DELIMITERS=',:]}'+_WHITESPACE
+
+class ItemParser():
+    """
+    Iterate over the items found at path in a JSON document delivered as chunks
+    of bytes or str, yielding (context, item) pairs.
+
+    path is a dotted list of object keys, a key followed by [] iterates over
+    the array it holds, e.g. 'Items[].Items[]' or 'data.records[]'.
+    A path starting with '[]' iterates over a document which is an array, e.g. '[]' or '[].Items[]'.
+    A null found along the path holds no items.
+    context is a dict of the scalar fields of the enclosing objects that precede
+    the nested key, inner objects overriding outer ones.
+    Once iterated, fields holds the scalar fields of the root object.
+
+    Only the items being decoded are held in memory, with the undecoded part of
+    the current chunk.
+    """
+    def __init__(self,chunks,path):
+        self.chunks=iter(chunks)
+        self.path=[(s[:-2],True) if s.endswith('[]') else (s,False) for s in path.split('.')]
+        self.decoder=json.JSONDecoder()
+        self.utf8=codecs.getincrementaldecoder('utf-8')()
+        self.buf=''
+        self.pos=0
+        self.eof=False
+        self.fields={}
+
+    def __iter__(self):
+        if self.path[0]==('',True):
+            yield from self._array(1,{})
+        else:
+            yield from self._walk(0,{},self.fields)
+        if self._peek() is not None:
+            raise ValueError(f"Extra data at position {self.pos} after the JSON document")
+
+    def _read(self):
+        ''' Append the next chunk to the buffer, dropping the consumed part; False at end of input '''
+        if self.eof:
+            return False
+        chunk=next(self.chunks,None)
+        if chunk is None:
+            self.eof=True
+            chunk=self.utf8.decode(b'',final=True)
+        elif isinstance(chunk,bytes):
+            chunk=self.utf8.decode(chunk)
+        self.buf=self.buf[self.pos:]+chunk
+        self.pos=0
+        return True
+
+    def _peek(self):
+        ''' Next non-blank character, None at end of input '''
+        while True:
+            while self.pos<len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos+=1
+            if self.pos<len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return None
+
+    def _expect(self,chars):
+        c=self._peek()
+        if c is None or c not in chars:
+            raise ValueError(f"Expecting one of '{chars}' at position {self.pos}, got {c!r}")
+        self.pos+=1
+        return c
+
+    def _value(self):
+        ''' Decode the next complete JSON value '''
+        self._peek()
+        while True:
+            try:
+                value,end=self.decoder.raw_decode(self.buf,self.pos)
+                # A number cut by the end of the buffer may continue in the next chunk
+                if self.eof or (end<len(self.buf) and self.buf[end] in _DELIMITERS):
+                    self.pos=end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+    def _walk(self,depth,context,fields):
+        ''' Walk the object at the current position down to path[depth:] '''
+        key,is_array=self.path[depth]
+        if self._peek()=='n':
+            self._value()
+            return
+        self._expect('{')
+        if self._peek()=='}':
+            self.pos+=1
+            return
+        while True:
+            k=self._value()
+            self._expect(':')
+            if k==key:
+                inner={**context,**fields}
+                if is_array:
+                    yield from self._array(depth+1,inner)
+                elif depth+1<len(self.path):
+                    yield from self._walk(depth+1,inner,{})
+                else:
+                    yield inner,self._value()
+            else:
+                v=self._value()
+                if not isinstance(v,(dict,list)):
+                    fields[k]=v
+            if self._expect(',}')=='}':
+                return
+
+    def _array(self,depth,context):
+        if self._peek()=='n':
+            self._value()
+            return
+        self._expect('[')
+        if self._peek()==']':
+            self.pos+=1
+            return
+        while True:
+            if depth<len(self.path):
+                yield from self._walk(depth,context,{})
+            else:
+                yield context,self._value()
+            if self._expect(',]')==']':
+                return
+
+def iterItems(chunks,path):
+    ''' Generate the (context, item) pairs at path of a chunked JSON document '''
+    return iter(ItemParser(chunks,path))
@@ -0,0 +1,423 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2021.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+# Maximo Monitor IoT Functions model loading utilities
+#
+# Models are kept in a process-wide LRU registry keyed by model path, so that
+# pipeline runs and function instances sharing a model only load it once.
+# The registry is configured through environment variables:
+#   PHG_IOTFUNCS_MODEL_CACHE_SIZE  number of models kept in memory (default 8)
+#   PHG_IOTFUNCS_MODEL_CACHE_TTL   seconds before a model is loaded again (default 1800)
+#                                  iotfunctions offers no cheap freshness check of a COS
+#                                  object, so each expiry downloads the model again; it
+#                                  is kept with its version when its digest is unchanged.
+#                                  A shorter ttl picks up new models sooner at the cost
+#                                  of one download per model and expiry.
+#   PHG_IOTFUNCS_MODEL_CACHE_DIR   local directory where models are also cached on disk
+#   PHG_IOTFUNCS_MODEL_MMAP        1 to keep disk cached models in joblib layout and
+#                                  memory-map their arrays read-only, so that worker
+#                                  processes share them through the OS page cache.
+#                                  This does not help tree models (decision trees, forests,
+#                                  gradient boosting): sklearn copies the tree node arrays
+#                                  when unpickling, so each process still holds its own
+#                                  copy. These are not reloaded from the mapped file.
+#
+# Written by Philippe Gregoire, IBM France, Hybrid CLoud Build Team Europe
+# *****************************************************************************
+
+import os, io, time, hashlib, pickle, threading, collections, weakref
+import logging
+
+logger = logging.getLogger(__name__)
+
+ENV_MODEL_CACHE_SIZE='PHG_IOTFUNCS_MODEL_CACHE_SIZE'
+ENV_MODEL_CACHE_TTL='PHG_IOTFUNCS_MODEL_CACHE_TTL'
+ENV_MODEL_CACHE_DIR='PHG_IOTFUNCS_MODEL_CACHE_DIR'
+ENV_MODEL_MMAP='PHG_IOTFUNCS_MODEL_MMAP'
+
+def checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+class ModelCache:
+    """
+    LRU registry of loaded models, keyed by model path.
+
+    A cached model is reused without any access to the object store during ttl
+    seconds. After that, it is loaded again with db.cos_load() and the sha256 of its
+    serialized form compared to the cached one: when unchanged, the cached model,
+    its version and its disk copy are kept, only their age is reset.
+    With a cache_dir, models are also stored on disk with their digest, so that
+    a new process can load them without the object store while the file is younger than ttl.
+    With mmap, they are stored in joblib layout and their numpy arrays are
+    memory-mapped read-only when loaded (requires joblib and a cache_dir).
+    Tree models gain nothing from it, as their node arrays are copied when loaded.
+    The version of a model, returned by version(), is its digest: it only changes
+    with the model content, including across reloads and disk loads.
+    Callers holding many models at once, such as per-device models, reserve()
+    room for them on top of max_entries, so that they are not evicted while in use.
+    """
+    def __init__(self,max_entries=8,ttl=1800,cache_dir=None,mmap=False):
+        self.max_entries=max_entries
+        self.ttl=ttl
+        self.cache_dir=cache_dir
+        self.mmap=mmap and cache_dir is not None
+        if self.mmap:
+            try:
+                import joblib
+            except ImportError:
+                logger.warning(f"joblib is not installed, models will not be memory-mapped")
+                self.mmap=False
+        # model_path -> [model, checked_at, digest]
+        self._models=collections.OrderedDict()
+        self._lock=threading.Lock()
+        self._path_locks=collections.defaultdict(threading.Lock)
+        # Extra entries reserved per owner
+        self._reserved={}
+
+    def reserve(self,owner,count):
+        ''' Keep room for count more models on behalf of owner, replacing its previous reservation '''
+        with self._lock:
+            self._reserved[owner]=count
+
+    def load(self,db,model_path,logger=logger):
+        ''' Load the model for model_path, from memory, disk or object store '''
+        return self.loadVersioned(db,model_path,logger=logger)[0]
+
+    def loadVersioned(self,db,model_path,logger=logger):
+        ''' Load the model for model_path, returns (model, version) '''
+        with self._lock:
+            path_lock=self._path_locks[model_path]
+        # Concurrent loads of the same model wait for the first one
+        with path_lock:
+            entry=self._get(model_path)
+            if entry is not None and time.time()-entry[1]<self.ttl:
+                return entry[0],entry[2]
+
+            # A fresher copy may have been stored on disk by another process
+            loaded=self._loadFromDisk(model_path,logger)
+            if loaded is None:
+                model=db.cos_load(model_path,binary=True)
+                data=pickle.dumps(model,protocol=pickle.HIGHEST_PROTOCOL)
+                digest=checksum(data)
+                if entry is not None and entry[2]==digest:
+                    logger.info(f"Model {model_path} reloaded from object store unchanged, digest {digest}")
+                    entry[1]=time.time()
+                    self._touchDisk(model_path)
+                    self._put(model_path,entry)
+                    return entry[0],entry[2]
+                logger.info(f"Model {model_path} loaded from object store, digest {digest}")
+                if self.mmap:
+                    # Reload from the joblib layout so that arrays are mapped rather than in the heap
+                    model=self._saveMapped(model_path,model,digest,logger) or model
+                elif self.cache_dir:
+                    self._saveToDisk(model_path,data,digest,logger)
+                loaded=(model,digest,time.time())
+
+            model,digest,checked_at=loaded
+            if entry is not None and entry[2]==digest:
+                # Same content as the cached model, keep it
+                entry[1]=checked_at
+            else:
+                entry=[model,checked_at,digest]
+            self._put(model_path,entry)
+            return entry[0],entry[2]
+
+    def version(self,model_path):
+        ''' Version of the cached model_path, the digest of its content, None when not cached '''
+        entry=self._get(model_path)
+        return entry[2] if entry is not None else None
+
+    def invalidate(self,model_path=None):
+        ''' Drop model_path, or all models, from the memory cache '''
+        with self._lock:
+            if model_path is None:
+                self._models.clear()
+            else:
+                self._models.pop(model_path,None)
+
+    def _get(self,model_path):
+        with self._lock:
+            entry=self._models.get(model_path)
+            if entry is not None:
+                self._models.move_to_end(model_path)
+            return entry
+
+    def _put(self,model_path,entry):
+        with self._lock:
+            self._models[model_path]=entry
+            self._models.move_to_end(model_path)
+            while len(self._models)>self.max_entries+sum(self._reserved.values()):
+                evicted,_=self._models.popitem(last=False)
+                logger.info(f"Evicted model {evicted} from cache")
+
+    def _diskPath(self,model_path):
+        return os.path.join(self.cache_dir,model_path.replace('/','_').replace('\\','_'))+('.joblib' if self.mmap else '')
+
+    def _loadFromDisk(self,model_path,logger):
+        ''' (model, digest, mtime) of the disk cached model_path, None when absent or older than ttl '''
+        if not self.cache_dir:
+            return None
+        path=self._diskPath(model_path)
+        try:
+            mtime=os.path.getmtime(path)
+            if time.time()-mtime>=self.ttl:
+                return None
+            # Digest of the serialized model the cached file was made from
+            with io.open(path+'.sha256') as f:
+                digest=f.read().strip()
+            if self.mmap:
+                import joblib
+                model=joblib.load(path,mmap_mode='r')
+            else:
+                with io.open(path,'rb') as f:
+                    data=f.read()
+                if checksum(data)!=digest:
+                    logger.warning(f"Checksum mismatch for cached model {path}, ignoring it")
+                    return None
+                model=pickle.loads(data)
+        except (OSError,EOFError,ValueError,pickle.UnpicklingError) as exc:
+            logger.debug(f"No usable cached model {path}: {exc}")
+            return None
+        logger.info(f"Model {model_path} {'memory-mapped' if self.mmap else 'loaded'} from disk cache {path}")
+        return model,digest,mtime
+
+    def _touchDisk(self,model_path):
+        ''' Reset the age of the disk cached model_path, checked unchanged '''
+        if self.cache_dir:
+            try:
+                os.utime(self._diskPath(model_path))
+            except OSError:
+                pass
+
+    def _saveToDisk(self,model_path,data,digest,logger):
+        try:
+            os.makedirs(self.cache_dir,exist_ok=True)
+            path=self._diskPath(model_path)
+            # Write under a temporary name so that other processes never read a partial file
+            tmp=f"{path}.{os.getpid()}.tmp"
+            with io.open(tmp,'wb') as f:
+                f.write(data)
+            with io.open(path+'.sha256','w') as f:
+                f.write(digest)
+            os.replace(tmp,path)
+        except OSError as exc:
+            logger.warning(f"Could not cache model {model_path} in {self.cache_dir}: {exc}")
+
+    def _saveMapped(self,model_path,model,digest,logger):
+        import joblib
+        try:
+            os.makedirs(self.cache_dir,exist_ok=True)
+            path=self._diskPath(model_path)
+            tmp=f"{path}.{os.getpid()}.tmp"
+            joblib.dump(model,tmp)
+            with io.open(path+'.sha256','w') as f:
+                f.write(digest)
+            os.replace(tmp,path)
+            # Tree models would copy the mapped node arrays, keep the loaded one
+            if treeModel(model):
+                return model
+            return joblib.load(path,mmap_mode='r')
+        except OSError as exc:
+            logger.warning(f"Could not cache mapped model {model_path} in {self.cache_dir}: {exc}")
+            return None
+
+_modelCache=None
+
+def getModelCache():
+    ''' The process-wide ModelCache, configured from the environment on first use '''
+    global _modelCache
+    if _modelCache is None:
+        _modelCache=ModelCache(max_entries=int(os.environ.get(ENV_MODEL_CACHE_SIZE,'8')),
+                               ttl=float(os.environ.get(ENV_MODEL_CACHE_TTL,'1800')),
+                               cache_dir=os.environ.get(ENV_MODEL_CACHE_DIR),
+                               mmap=os.environ.get(ENV_MODEL_MMAP,'').lower() in ('1','true','yes'))
+    return _modelCache
+
+def loadModel(db,model_path,logger=logger):
+    ''' Load a model through the process-wide cache '''
+    return getModelCache().load(db,model_path,logger=logger)
+
+def loadModelVersion(db,model_path,logger=logger):
+    ''' Load a model through the process-wide cache, returns (model, version) '''
+    return getModelCache().loadVersioned(db,model_path,logger=logger)
+
+def predictChunked(model,X,chunk_size=None,n_workers=None,logger=logger):
+    """
+    Call model.predict() on X split in chunks of chunk_size rows, scored by a pool
+    of n_workers threads. Predictions are returned in the row order of X.
+    """
+    import numpy as np
+
+    n=len(X)
+    if not chunk_size or chunk_size>=n:
+        return model.predict(X)
+
+    slicer=X.iloc if hasattr(X,'iloc') else X
+    chunks=[slicer[i:i+chunk_size] for i in range(0,n,chunk_size)]
+    n_workers=max(1,min(n_workers or 1,len(chunks)))
+    logger.info(f"Predicting {n} rows in {len(chunks)} chunks of {chunk_size} with {n_workers} threads")
+
+    if n_workers==1:
+        results=[model.predict(c) for c in chunks]
+    else:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+            results=list(pool.map(model.predict,chunks))
+    return np.concatenate(results)
+
+# Estimators which convert their input to float32 internally, so can be fed float32 directly
+FLOAT32_ESTIMATORS={'DecisionTreeClassifier','DecisionTreeRegressor','ExtraTreeClassifier','ExtraTreeRegressor',
+                    'RandomForestClassifier','RandomForestRegressor','ExtraTreesClassifier','ExtraTreesRegressor',
+                    'GradientBoostingClassifier','GradientBoostingRegressor','IsolationForest'}
+
+def treeModel(model):
+    ''' True for tree based estimators, or pipelines ending with one, whose node arrays sklearn copies when unpickling '''
+    steps=getattr(model,'steps',None)
+    if steps:
+        model=steps[-1][1]
+    return type(model).__name__ in FLOAT32_ESTIMATORS
+
+# Feature columns and dtype per model, per (dependent_variables, frame columns)
+_featureLayouts=weakref.WeakKeyDictionary()
+
+def selectsColumns(model):
+    ''' True for pipelines and column transformers, which may select or encode their input columns by name '''
+    try:
+        from sklearn.pipeline import Pipeline
+        from sklearn.compose import ColumnTransformer
+    except ImportError:
+        return False
+    return isinstance(model,(Pipeline,ColumnTransformer))
+
+def featureLayout(model,df,dependent_variables):
+    """
+    The (columns,dtype) of the feature matrix for model, computed once per model and frame layout.
+    With dependent_variables '*', the model's fitted feature names are used when
+    known, otherwise all the numeric columns of df.
+    """
+    import numpy as np, pandas as pd
+
+    key=(dependent_variables if isinstance(dependent_variables,str) else tuple(dependent_variables),tuple(df.columns))
+    try:
+        layouts=_featureLayouts.setdefault(model,{})
+    except TypeError:
+        # Model cannot be weakly referenced, do not cache
+        layouts={}
+    if key not in layouts:
+        if dependent_variables!='*':
+            columns=[dependent_variables] if isinstance(dependent_variables,str) else list(dependent_variables)
+        elif hasattr(model,'feature_names_in_') and all(c in df.columns for c in model.feature_names_in_):
+            columns=list(model.feature_names_in_)
+        else:
+            columns=[c for c in df.columns if pd.api.types.is_numeric_dtype(df[c].dtype)]
+        dtype=np.float32 if type(model).__name__ in FLOAT32_ESTIMATORS else np.float64
+        layouts[key]=(columns,dtype)
+        logger.info(f"Feature layout for {type(model).__name__}: {dtype.__name__} {columns}")
+    return layouts[key]
+
+def featureMatrix(model,df,dependent_variables,rows=None,block_rows=4096):
+    """
+    Build the C-contiguous feature matrix given to model.predict(), filled from
+    the df columns without an intermediate DataFrame copy.
+    rows optionally selects the row positions of df to include.
+    Rows are filled by blocks which fit in cache, as column writes are strided.
+    """
+    import numpy as np
+
+    columns,dtype=featureLayout(model,df,dependent_variables)
+    values=[df[c].to_numpy(na_value=np.nan) for c in columns]
+    if rows is not None:
+        values=[v[rows] for v in values]
+    n=len(values[0]) if values else (len(df) if rows is None else len(rows))
+    X=np.empty((n,len(columns)),dtype=dtype)
+    for i in range(0,n,block_rows):
+        block=X[i:i+block_rows]
+        for j,v in enumerate(values):
+            block[:,j]=v[i:i+block_rows]
+    return X
+
+def featureInput(model,df,dependent_variables,rows=None):
+    """
+    The input given to model.predict(): the df columns selected as a DataFrame for
+    pipelines and column transformers, or when features are not all numeric,
+    otherwise the featureMatrix().
+    The matrix is wrapped in a DataFrame without copy when the model was fitted
+    with the same feature names, so that they are checked by the model.
+    """
+    import pandas as pd
+
+    columns,dtype=featureLayout(model,df,dependent_variables)
+    if selectsColumns(model) or not all(pd.api.types.is_numeric_dtype(df[c].dtype) for c in columns):
+        return df[columns] if rows is None else df[columns].iloc[rows]
+    X=featureMatrix(model,df,dependent_variables,rows=rows)
+    names=getattr(model,'feature_names_in_',None)
+    if names is not None and list(names)==columns:
+        return pd.DataFrame(X,columns=columns,copy=False)
+    return X
+
+class IncrementalScores:
+    """
+    Per-device watermark of the last scored timestamp and predictions of the
+    last scored window, for one predicted output, with the version of the
+    model each device was scored with.
+    Indexes are the (id,timestamp) entity indexes.
+    """
+    def __init__(self):
+        self.watermarks=None
+        self.predictions=None
+        self.versions={}
+
+    def checkVersions(self, versions):
+        ''' Forget the devices whose model version changed, versions is a dict of model versions by device id '''
+        changed=[d for d,v in versions.items() if d in self.versions and self.versions[d]!=v]
+        self.versions.update(versions)
+        if changed and self.predictions is not None:
+            logger.info(f"Model changed for {len(changed)} devices, scoring their rows again")
+            self.watermarks=self.watermarks.drop(changed,errors='ignore')
+            self.predictions=self.predictions[~self.predictions.index.get_level_values(0).isin(changed)]
+
+    def toScore(self, index):
+        ''' Mask of the rows newer than their device watermark, or without a previous prediction '''
+        import numpy as np, pandas as pd
+        if self.predictions is None:
+            return np.ones(len(index),dtype=bool)
+        marks=self.watermarks.reindex(index.get_level_values(0)).to_numpy()
+        newer=~(pd.Series(index.get_level_values(1)).to_numpy()<=marks)
+        return newer | ~index.isin(self.predictions.index)
+
+    def combine(self, index, toScore, predicted):
+        ''' Predictions for index, from predicted for the toScore rows and from the cache for the others '''
+        import numpy as np
+        if predicted is not None and toScore.all():
+            return predicted
+        cached=self.predictions.reindex(index).to_numpy()
+        if predicted is None:
+            return cached
+        out=np.empty(len(index),dtype=predicted.dtype if predicted.dtype==cached.dtype else object)
+        out[toScore]=predicted
+        out[~toScore]=cached[~toScore]
+        return out
+
+    def update(self, index, predictions):
+        ''' Keep the predictions of the current window and move the watermarks forward '''
+        import pandas as pd
+        predictions=pd.Series(predictions,index=index)
+        self.predictions=predictions[~index.duplicated(keep='last')]
+        marks=pd.Series(index.get_level_values(1),index=index.get_level_values(0)).groupby(level=0).max()
+        if self.watermarks is not None:
+            marks=pd.concat([self.watermarks,marks]).groupby(level=0).max()
+        self.watermarks=marks
+
+# Incremental scores per (entity type, model path, predicted item), for the process lifetime
+_incrementalScores={}
+
+def getIncrementalScores(key):
+    if key not in _incrementalScores:
+        _incrementalScores[key]=IncrementalScores()
+    return _incrementalScores[key]
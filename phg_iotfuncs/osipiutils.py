@@ -44,9 +44,10 @@ def plog(msg,level=logging.DEBUG,logger=logger):
     if logger.isEnabledFor(level):
         logger.log(level,pformat(msg))
 
-def getFromPi(srvParams,url=None,pipath=None,logger=logger):
+def getFromPi(srvParams,url=None,pipath=None,stream=False,logger=logger):
     ''' Issue a GET request to OSPi API
         srvParams has attributes pihost, piport, piuser, pipass
+        Returns the decoded JSON, or the response itself when stream is True
     '''
     import requests, base64
 
@@ -56,12 +57,24 @@ def getFromPi(srvParams,url=None,pipath=None,logger=logger):
     if pipath: piurl=f"{piurl}/{pipath}"
     dQ='"'
     logger.info(f"Curl equivalent: curl -k -X GET {' '.join(['-H '+dQ+h+':'+v+dQ for h,v in hdr.items()])} \"{piurl}\"")
-    resp=requests.request('GET',piurl,verify=False,headers=hdr) # cert=args.picert,
+    resp=requests.request('GET',piurl,verify=False,headers=hdr,stream=stream) # cert=args.picert,
     if not resp.ok:
         resp.reason
         logger.error(f"Error {resp.reason} calling {piurl}")
         raise Exception(resp)
-    return resp.json()
+    return resp if stream else resp.json()
+
+def streamFromPi(srvParams,url,path,chunk_size=1<<16,logger=logger):
+    ''' Generate the (context, item) pairs at path (e.g. 'Items[].Items[]') of a GET response,
+        parsed as it is received rather than decoded as a whole
+    '''
+    from phg_iotfuncs import json_utils
+
+    resp=getFromPi(srvParams,url,stream=True,logger=logger)
+    try:
+        yield from json_utils.iterItems(resp.iter_content(chunk_size=chunk_size),path)
+    finally:
+        resp.close()
 
 def selectedFields(fields,prefix='Items',sep=';'):
     ''' Helper function '''
@@ -100,20 +113,21 @@ def getOSIPiPoints(piSrvParams, pointsNameFilter,valueFields,logger=logger):
     for datasrv in r_datasrvrs['Items']:
         plog(datasrv,logger=logger)
         # build the request to get only points matching the provided filter and only selected fields        
-        r_points=getFromPi(piSrvParams,f"{datasrv['Links']['Points']}?nameFilter={pointsNameFilter}&selectedFields=Items.Name;Items.PointType;Items.Links.RecordedData")
-        # plog(r_points)
-        logger.info(f"Found {len(r_points['Items'])} points that match filter {pointsNameFilter}")
+        points=[point for _,point in streamFromPi(piSrvParams,f"{datasrv['Links']['Points']}?nameFilter={pointsNameFilter}&selectedFields=Items.Name;Items.PointType;Items.Links.RecordedData",'Items[]',logger=logger)]
+        logger.info(f"Found {len(points)} points that match filter {pointsNameFilter}")
 
-        # Dump first point for debugging
-        plog(r_points['Items'][0],logger=logger)
-        plog(getFromPi(piSrvParams,r_points['Items'][0]['Links']['RecordedData']),logger=logger)
+        # Dump first point for debugging, its recorded data is only fetched when debug logging is on
+        if len(points)>0 and logger.isEnabledFor(logging.DEBUG):
+            plog(points[0],logger=logger)
+            plog(getFromPi(piSrvParams,points[0]['Links']['RecordedData'],logger=logger),logger=logger)
 
-        # Get the values
+        # Get the values, parsed as they are received
         pointValues={}
-        for point in r_points['Items']:
-            r_ptvals=getFromPi(piSrvParams,point['Links']['RecordedData']+f"?selectedFields={selectedFields(valueFields)}")
-            pointValues[point['Name']]=[{f:v[f] for f in valueFields} for v in r_ptvals['Items']]
-            logger.debug(f"{point['Name']}\t[#{len(r_ptvals['Items'])}]\t= {TAB.join(str(r_ptvals['Items'][-1][f]) for f in valueFields)}")
+        for point in points:
+            values=[{f:v[f] for f in valueFields} for _,v in streamFromPi(piSrvParams,point['Links']['RecordedData']+f"?selectedFields={selectedFields(valueFields)}",'Items[]',logger=logger)]
+            pointValues[point['Name']]=values
+            if len(values)>0:
+                logger.debug(f"{point['Name']}\t[#{len(values)}]\t= {TAB.join(str(values[-1][f]) for f in valueFields)}")
         return pointValues
 
 def mapPointValues(ptVals,deviceAttr,point_attr_map,logger=logger):
@@ -214,8 +228,10 @@ def getParentElements(piSrvParams,parentElementPath,logger=logger):
     
     return None
 
-def getOSIPiElements(piSrvParams, parentElementPath,valueFields,deviceField,startTime=None,interval=None,logger=logger):
+def getOSIPiElements(piSrvParams, parentElementPath,valueFields,deviceField,startTime=None,interval=None,keep_raw=False,logger=logger):
     """ Returns a dictionary indexed by (timestamp,deviceid) and the raw json output from the API
+        The data responses are parsed as they are received, the raw output is only
+        kept when keep_raw is set.
 
         Parameters
         ==========
@@ -231,6 +247,8 @@ def getOSIPiElements(piSrvParams, parentElementPath,valueFields,deviceField,star
             Starting timestamp
         interval:
             interpolation interval (e.g. '1h', '10s', '1m'). If None, use recorded Data
+        keep_raw:
+            Also return the raw Items of each device, empty dict otherwise
         logger:
             a logger to use for tracing
     """
@@ -288,26 +306,27 @@ def getOSIPiElements(piSrvParams, parentElementPath,valueFields,deviceField,star
         if startTime is not None:
             # If the startTime is not a datetime.datetime at this stage, use as plain string repr, else us isoformat 
             piurl+=f"&boundaryType=Outside&startTime={startTime.isoformat() if isinstance(startTime,dt.datetime) else startTime}"
-        r_data=getFromPi(piSrvParams,piurl,logger=logger)
-        plog(r_data,logger=logger)
-        OSIPiRawData[deviceId]=r_data['Items']
-        # Iterate over the Items returned by OSIPi API
-        for d in r_data['Items']:
+        # Iterate over the values of the Items returned by OSIPi API, as they are received
+        rawItems=OSIPiRawData.setdefault(deviceId,[]) if keep_raw else None
+        for attr,item in streamFromPi(piSrvParams,piurl,'Items[].Items[]',logger=logger):
             # Extract the name of the attribute
-            attr_name=d['Name']
-            #attr_type=d['PointType']
+            attr_name=attr['Name']
+            #attr_type=attr['PointType']
+            if keep_raw:
+                if len(rawItems)==0 or rawItems[-1]['Name']!=attr_name:
+                    rawItems.append({**attr,'Items':[]})
+                rawItems[-1]['Items'].append(item)
             # Attribute has a list of values in the form of an array of {"Timestamp": ts, "Value": float}
-            for item in d['Items']:
-                # Get the timestamp and value for this attribute
-                ts=item[ATTR_FIELD_TS]
-                attr_value=item[ATTR_FIELD_VAL]
-                # Note: filter out entries that are of type dict and 
-                if not isinstance(attr_value,dict):
-                    # If this timestamp for this deviceid has never been seen, initialize it to {"TimeStamp":ts, "DeviceId": id}
-                    if (ts,deviceId) not in sensorValues:
-                        sensorValues[(ts,deviceId)]={ATTR_FIELD_TS:ts, deviceField:deviceId}
-                    # Add the value for this attribute to this (ts,deviceid) entry
-                    sensorValues[(ts,deviceId)][attr_name]=item[ATTR_FIELD_VAL]
+            # Get the timestamp and value for this attribute
+            ts=item[ATTR_FIELD_TS]
+            attr_value=item[ATTR_FIELD_VAL]
+            # Note: filter out entries that are of type dict and 
+            if not isinstance(attr_value,dict):
+                # If this timestamp for this deviceid has never been seen, initialize it to {"TimeStamp":ts, "DeviceId": id}
+                if (ts,deviceId) not in sensorValues:
+                    sensorValues[(ts,deviceId)]={ATTR_FIELD_TS:ts, deviceField:deviceId}
+                # Add the value for this attribute to this (ts,deviceid) entry
+                sensorValues[(ts,deviceId)][attr_name]=attr_value
 
     return sensorValues,OSIPiRawData
 
@@ -0,0 +1,234 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2021.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+# Maximo Monitor IoT Functions performance diagnostic utilities
+#
+# Profiling is switched on without redeploying the package, through the
+# following environment variables of the pipeline process:
+#   PHG_IOTFUNCS_PROFILE_DIR    directory where profile dumps are written
+#   PHG_IOTFUNCS_PROFILE_EVERY  profile only one run in N (default 1, every run)
+#   PHG_IOTFUNCS_PROFILER       'cprofile' (default) or 'pyinstrument' (sampling,
+#                               used only when the package is installed)
+# Memory tracking is switched on the same way:
+#   PHG_IOTFUNCS_MEMTRACK       1 to record per-stage peak memory and largest frames
+#   PHG_IOTFUNCS_MEM_WARN_MB    size above which a warning is logged and frames
+#                               are written in chunks
+#
+# Written by Philippe Gregoire, IBM France, Hybrid CLoud Build Team Europe
+# *****************************************************************************
+
+import os, io, contextlib, itertools
+import datetime as dt
+import logging
+
+logger = logging.getLogger(__name__)
+
+ENV_PROFILE_DIR='PHG_IOTFUNCS_PROFILE_DIR'
+ENV_PROFILE_EVERY='PHG_IOTFUNCS_PROFILE_EVERY'
+ENV_PROFILER='PHG_IOTFUNCS_PROFILER'
+
+# Run counters, per profiled name, used for run sampling
+_runCounters={}
+
+def _nextRun(name):
+    if name not in _runCounters:
+        _runCounters[name]=itertools.count()
+    return next(_runCounters[name])
+
+def profileSettings(profile_dir=None,profile_every=None):
+    ''' Get the (profile_dir,profile_every) settings, explicit values override environment '''
+    if profile_dir is None:
+        profile_dir=os.environ.get(ENV_PROFILE_DIR)
+    if profile_every is None:
+        try:
+            profile_every=int(os.environ.get(ENV_PROFILE_EVERY,'1'))
+        except ValueError:
+            logger.warning(f"Invalid {ENV_PROFILE_EVERY}={os.environ.get(ENV_PROFILE_EVERY)}, profiling every run")
+            profile_every=1
+    return profile_dir,max(1,int(profile_every))
+
+@contextlib.contextmanager
+def profiledRun(name,profile_dir=None,profile_every=None,logger=logger):
+    """
+    Context manager which profiles the enclosed code when profiling is enabled
+    and the run is sampled, writing one dump per profiled run to profile_dir.
+
+    name is used for the run counter and as the dump file name prefix.
+    """
+    profile_dir,profile_every=profileSettings(profile_dir,profile_every)
+    if not profile_dir or _nextRun(name)%profile_every!=0:
+        yield
+        return
+
+    os.makedirs(profile_dir,exist_ok=True)
+    stamp=dt.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    dump_base=os.path.join(profile_dir,f"{name}_{stamp}_{os.getpid()}")
+
+    profiler=None
+    if os.environ.get(ENV_PROFILER,'cprofile').lower()=='pyinstrument':
+        try:
+            import pyinstrument
+            profiler=pyinstrument.Profiler()
+        except ImportError:
+            logger.warning(f"pyinstrument not installed, falling back to cProfile")
+
+    if profiler is not None:
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with io.open(dump_base+'.html','w',encoding='utf-8') as f:
+                f.write(profiler.output_html())
+            logger.info(f"Wrote {name} sampling profile to {dump_base}.html")
+    else:
+        import cProfile
+        profiler=cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(dump_base+'.prof')
+            logger.info(f"Wrote {name} profile to {dump_base}.prof")
+
+class ProfiledMixin:
+    """
+    Mixin for functions whose runs can be profiled, profile_dir and profile_every
+    class attributes override the environment settings
+    """
+    # Set to a directory to profile runs, overrides PHG_IOTFUNCS_PROFILE_DIR
+    profile_dir = None
+    # Profile one run in profile_every, overrides PHG_IOTFUNCS_PROFILE_EVERY
+    profile_every = None
+
+    def profiledRun(self,logger=logger):
+        ''' Context manager profiling the enclosed code as a run of this function class '''
+        return profiledRun(self.__class__.__name__,self.profile_dir,self.profile_every,logger=logger)
+
+ENV_MEMTRACK='PHG_IOTFUNCS_MEMTRACK'
+ENV_MEM_WARN_MB='PHG_IOTFUNCS_MEM_WARN_MB'
+
+def objectSize(obj):
+    ''' Approximate memory size in bytes of a DataFrame, or of a dict of records such as elemVals '''
+    import sys
+    if hasattr(obj,'memory_usage'):
+        usage=obj.memory_usage(deep=True)
+        return int(usage.sum() if hasattr(usage,'sum') else usage)
+    size=sys.getsizeof(obj)
+    if isinstance(obj,dict):
+        for k,v in obj.items():
+            size+=sys.getsizeof(k)+sys.getsizeof(v)
+            if isinstance(v,dict):
+                size+=sum(sys.getsizeof(i) for i in v.values())
+    return size
+
+def rssHighWater():
+    ''' Process peak resident set size in bytes, None when not available (e.g. on Windows) '''
+    try:
+        import resource, sys
+    except ImportError:
+        return None
+    maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in kilobytes on Linux
+    return maxrss if sys.platform=='darwin' else maxrss*1024
+
+class MemoryTracker:
+    """
+    Tracks per-stage peak memory (tracemalloc and RSS high-water) and the
+    largest objects created during a run.
+
+    Enabled by PHG_IOTFUNCS_MEMTRACK=1, objects larger than
+    PHG_IOTFUNCS_MEM_WARN_MB are logged as warnings and flagged so that callers
+    can process them in chunks.
+    """
+    def __init__(self,name,enabled=None,warn_mb=None,top_objects=5,logger=logger):
+        self.name=name
+        self.logger=logger
+        self.enabled=enabled if enabled is not None else os.environ.get(ENV_MEMTRACK,'').lower() in ('1','true','yes')
+        if warn_mb is None:
+            warn_mb=os.environ.get(ENV_MEM_WARN_MB)
+        self.warn_bytes=int(float(warn_mb)*1024*1024) if warn_mb else None
+        self.top_objects=top_objects
+        self.stages=[]
+        self.objects=[]
+        self._open=[]
+        self._started_tracing=False
+
+    def start(self):
+        if self.enabled:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing=True
+        return self
+
+    @contextlib.contextmanager
+    def stage(self,stage_name):
+        ''' Record the peak memory reached while running the enclosed stage '''
+        if not self.enabled:
+            yield
+            return
+        import tracemalloc
+        # Keep enclosing stages peaks before resetting for this one
+        _,peak=tracemalloc.get_traced_memory()
+        self._open=[max(p,peak) for p in self._open]+[0]
+        tracemalloc.reset_peak()
+        rss_before=rssHighWater()
+        try:
+            yield
+        finally:
+            _,peak=tracemalloc.get_traced_memory()
+            peak=max(peak,self._open.pop())
+            self._open=[max(p,peak) for p in self._open]
+            rss_after=rssHighWater()
+            self.stages.append((stage_name,peak,rss_after))
+            self.logger.info(f"{self.name} stage {stage_name}: traced peak={peak/1048576:.1f}MB"
+                             + (f" rss high-water={rss_after/1048576:.1f}MB (+{(rss_after-rss_before)/1048576:.1f}MB)" if rss_after else ''))
+            if self.warn_bytes and peak>self.warn_bytes:
+                self.logger.warning(f"{self.name} stage {stage_name} peaked at {peak/1048576:.1f}MB over threshold {self.warn_bytes/1048576:.1f}MB")
+
+    def recordObject(self,label,obj):
+        ''' Record the size of obj, returns True when it is over the warning threshold '''
+        if not self.enabled and self.warn_bytes is None:
+            return False
+        size=objectSize(obj)
+        self.objects.append((size,label))
+        self.objects=sorted(self.objects,reverse=True)[:self.top_objects]
+        self.logger.debug(f"{self.name} {label} size={size/1048576:.1f}MB")
+        if self.warn_bytes and size>self.warn_bytes:
+            self.logger.warning(f"{self.name} {label} size {size/1048576:.1f}MB is over threshold {self.warn_bytes/1048576:.1f}MB")
+            return True
+        return False
+
+    def chunks(self,df):
+        ''' Split df in row chunks each under the warning threshold, or yield df unchanged '''
+        size=objectSize(df) if self.warn_bytes else 0
+        if not self.warn_bytes or size<=self.warn_bytes or len(df)<2:
+            yield df
+            return
+        nChunks=min(len(df),-(-size//self.warn_bytes))
+        rows=-(-len(df)//nChunks)
+        self.logger.info(f"{self.name} processing {len(df)} rows in {nChunks} chunks of {rows} rows")
+        for i in range(0,len(df),rows):
+            yield df.iloc[i:i+rows]
+
+    def report(self):
+        ''' Log the run summary and stop tracing if started by this tracker '''
+        if not self.enabled:
+            return
+        if self.stages:
+            worst=max(self.stages,key=lambda s: s[1])
+            self.logger.info(f"{self.name} highest stage peak {worst[0]}={worst[1]/1048576:.1f}MB over stages {[s[0] for s in self.stages]}")
+        if self.objects:
+            self.logger.info(f"{self.name} largest objects: {', '.join(f'{l}={s/1048576:.1f}MB' for s,l in self.objects)}")
+        if self._started_tracing:
+            import tracemalloc
+            tracemalloc.stop()
+            self._started_tracing=False
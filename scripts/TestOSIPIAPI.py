@@ -48,7 +48,7 @@ def testElementsAPI(args):
 
     # Fetch the Elements from OSIPi Server.
     attrFields=[osipiutils.ATTR_FIELD_VAL,osipiutils.ATTR_FIELD_TS]
-    elemVals,rawElemsJSON=osipiutils.getOSIPiElements(args,args.parent_element_path,attrFields,func_osipi.DEVICE_ATTR,startTime=args.startTime,interval=args.interval)
+    elemVals,rawElemsJSON=osipiutils.getOSIPiElements(args,args.parent_element_path,attrFields,func_osipi.DEVICE_ATTR,startTime=args.startTime,interval=args.interval,keep_raw=True)
 
     # Get into DataFrame table form indexed by timestamp 
     df=osipiutils.convertToEntities(elemVals,args.date_field,func_osipi.DEVICE_ATTR)
@@ -1,129 +1,270 @@
 ## Act as a device to send data works on Python 3.7 (but not 3.6, async.run() not there)
 # Send data from a CSV file as an IoT Device
+# or from a directory of CSV files as a fleet of devices, named after the part of each file name after -@
 # Requires 'pip install azure-iot-device'
 # Adapted by Philippe Gregoire, IBM France, Hybrid CLoud Build Team Europe
 
 
 # You will get the connection string from your device on IoTHub
-import sys, os, io, asyncio, json
+import sys, os, io, asyncio, json, time
 
 import azure.iot.device.aio
 import azure.iot.device
 
-async def main(argv):
-
-    import argparse
-    parser = argparse.ArgumentParser(description=f"Tester for AMQPPreload iotfunction")
-    parser.add_argument('deviceId', type=str, help=f"Device ID (or csv file if omitted, in which case deviceId is the last part of filename after -@)")
-    parser.add_argument('csvFile', type=str, help=f"Name of CSV file", nargs='?',default=None)
-    parser.add_argument('-count', type=int, help=f"Count of messages to send", default=10)
-    parser.add_argument('-offset', type=int, help=f"Offset of first message to send", default='0')
-    parser.add_argument('-norebase', help=f"Do not rebase time stamp from now", action='store_true')
-    parser.add_argument('-pace', help=f"Pace data sending, respecting timestamps intervals", action='store_true')
-    parser.add_argument('-maxDelayMult', type=float, help=f"When pacing, clip time gaps that are over x times the previous value", default=1.5)
-    parser.add_argument('-dateField', type=str, help=f"Date field, default to first column", default=None)
-    parser.add_argument('-test', help=f"Test only, don't send", action='store_true')
-    parser.add_argument('--iothubcreds', type=str, help=f"IoT Hub credentials file",default=os.path.join(os.path.dirname(__file__),f"creds_iothub_{os.environ['USERNAME']}.json"))
-    args = parser.parse_args(argv[1:])
-
-    device_id=args.deviceId
-    csv_file=args.csvFile
-    if csv_file is None:
-        csv_file=device_id
-        device_id=csv_file.split('.')[-2].split('-@')[-1]
-    messages_to_send=args.count
-    offset=args.offset
-    with io.open(args.iothubcreds) as f:
-        iothub_creds = json.load(f)
-    iot_hub_name=iothub_creds['iot_hub_name']
-    access_key=iothub_creds['devices_access_keys'][device_id][0]
+class TokenBucket():
+    ''' Token bucket rate limiter for asyncio tasks, rate in tokens per second (unlimited if 0) '''
+    def __init__(self,rate,burst=None):
+        self.rate=rate
+        self.capacity=burst if burst else max(1,rate)
+        self.tokens=self.capacity
+        self.last=time.monotonic()
 
+    async def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            now=time.monotonic()
+            self.tokens=min(self.capacity,self.tokens+(now-self.last)*self.rate)
+            self.last=now
+            if self.tokens>=1:
+                self.tokens-=1
+                return
+            # Yield to the other senders until the next token is available
+            await asyncio.sleep((1-self.tokens)/self.rate)
 
-    print(f"Using CSV file: {csv_file} and device {device_id}")
+class SendStats():
+    ''' Count of messages and bytes sent, with the send latencies and delays behind the pacing schedule '''
+    def __init__(self):
+        self.start=time.monotonic()
+        self.messages=0
+        self.bytes=0
+        self.latencies=[]
+        self.lags=[]
 
-    # The connection string for a device should never be stored in code. For the sake of simplicity we're using an environment variable here.
-    conn_str=f"HostName={iot_hub_name}.azure-devices.net;DeviceId={device_id};SharedAccessKey={access_key}"
+    def add(self,size,latency,lag=None):
+        self.messages+=1
+        self.bytes+=size
+        self.latencies.append(latency)
+        if lag is not None:
+            self.lags.append(lag)
 
-    print(f"Connecting to {iot_hub_name}, about to send {messages_to_send} messages from offset {offset}")
+    def report(self,label='Sent'):
+        import numpy as np
+        elapsed=max(time.monotonic()-self.start,1e-9)
+        msg=f"{label} {self.messages} messages, {self.bytes/1024:.1f}KB in {elapsed:.2f}s: {self.messages/elapsed:.1f} msg/s"
+        if self.latencies:
+            p50,p95,p99=np.percentile(np.asarray(self.latencies)*1000,[50,95,99])
+            msg+=f", latency ms p50={p50:.1f} p95={p95:.1f} p99={p99:.1f} max={max(self.latencies)*1000:.1f}"
+        if self.lags:
+            p50,p99=np.percentile(np.asarray(self.lags)*1000,[50,99])
+            msg+=f", behind schedule ms p50={p50:.1f} p99={p99:.1f} max={max(self.lags)*1000:.1f}"
+        print(msg)
 
-    # The client object is used to interact with your Azure IoT hub.
-    device_client = azure.iot.device.aio.IoTHubDeviceClient.create_from_connection_string(conn_str)
+def device_of(csv_file):
+    ''' Device id from the CSV file name: the last part of the file name after -@ '''
+    return os.path.basename(csv_file).split('.')[-2].split('-@')[-1]
 
+def read_rows(csv_file,offset,count,date_field=None):
+    ''' Read the CSV rows to send, return the frame, its date field and parsed timestamps '''
     import pandas as pd
-    #df=pd.read_csv(csv_file,parse_dates=['date'],infer_datetime_format=True,skiprows=offset,nrows=messages_to_send)
-    df=pd.read_csv(csv_file,parse_dates=None,infer_datetime_format=False,nrows=offset+messages_to_send)
+
+    df=pd.read_csv(csv_file,parse_dates=None,nrows=offset+count)
 
     # drop the offset first rows
     df=df.iloc[offset:]
-    print(f"Got data frame of shape {df.shape}")
-
-    original_columns=df.columns
+    print(f"Got data frame of shape {df.shape} from {csv_file}")
 
-    # Rebase date column, Add a column with rebased timestamps
-    date_field=args.dateField
     if date_field is None:
         date_field=df.columns[0]
+    return df,date_field,pd.to_datetime(df[date_field])
+
+def serialize(df,date_field,ts):
+    '''
+    Serialize all records to JSON, keys in the CSV column order, dates in their str() format.
+    Floats keep their full precision and missing values are sent as null.
+    '''
+    df=df.copy()
+    df[date_field]=ts.astype(str).to_numpy()
+    records=df.astype(object).where(df.notna(),None).to_dict('records')
+    return [json.dumps(r,ensure_ascii=False,separators=(',',':')) for r in records]
+
+def load_messages(csv_file,offset,count,date_field=None,rebase=True,pace=False,max_delay_mult=1.5,speedup=1.0):
+    '''
+    Read the CSV rows to send and serialize them once to JSON.
+    Returns the payloads, and when pacing the due time of each message in seconds from the start,
+    time gaps being divided by speedup. When pacing, the date of each message is its due time, rebased on now.
+    '''
+    import numpy as np, pandas as pd
+    from datetime import datetime
+
+    df,date_field,ts=read_rows(csv_file,offset,count,date_field)
     print(f"Using date_field={date_field}")
-    # Convert date to rebase it
-    df[date_field]=pd.to_datetime(df[date_field])
+
+    due=None
+    if pace:
+        # Time gaps are clipped to max_delay_mult times the previous gap
+        gaps=ts.diff().dt.total_seconds().fillna(0).astype(int).to_numpy(copy=True)
+        for i in range(2,len(gaps)):
+            if gaps[i]>int(gaps[i-1]*max_delay_mult):
+                print(f"Time gap {gaps[i]} > {gaps[i-1]}*{max_delay_mult}, clipping to {int(gaps[i-1]*max_delay_mult)}")
+                gaps[i]=int(gaps[i-1]*max_delay_mult)
+        due=np.cumsum(gaps)/speedup
+        if rebase:
+            ts=pd.Timestamp(datetime.utcnow())+pd.to_timedelta(due,unit='s')
+    elif rebase:
+        # Not pacing, all records are sent at once, projected in the past up to the latest (max)
+        deltaTS=datetime.utcnow()-ts.max()
+        print(f"Rebasing timestamp to delta {deltaTS}")
+        ts=deltaTS+ts
+
+    payloads=serialize(df,date_field,ts)
+    print(payloads[0] if payloads else "No rows to send")
+    return payloads,due
+
+def load_fleet(csv_files,offset,count,date_field=None,rebase=True,pace=False,speedup=1.0):
+    '''
+    Read and serialize the messages of a fleet of devices, one CSV file each.
+    Devices keep their relative timing: when pacing, due times are measured from the earliest
+    timestamp of the whole fleet, divided by speedup; time gaps are not clipped.
+    Returns a dict of (payloads, due) by device id.
+    '''
+    import pandas as pd
     from datetime import datetime
 
-    # Note: if we are not pacing, we send all records at once, projected in the past up to the latest (max)
-    # If we are pacing, we rebase from the earliest (min) and increment from there
-    deltaTS=datetime.utcnow()-(df[date_field].min() if args.pace else df[date_field].max())
-
-    print(f"Rebasing timestamp to delta {deltaTS}")
-    if not args.norebase:
-        df[date_field]=deltaTS+df[date_field]
-    # keep rebased column
-    df[f"rebase_{date_field}"]=df[date_field]
-    # convert back to string format otherwise cannot serialize with JSON
-    df[date_field]=df[date_field].astype(str)
-    print(df.head(2))
-    print("...........")
-    print(df.tail(2))
+    rows={device_of(f):read_rows(f,offset,count,date_field) for f in csv_files}
+    stamps=[ts for _,_,ts in rows.values() if len(ts)>0]
+    if len(stamps)==0:
+        return {}
+    first=min(ts.min() for ts in stamps)
+    last=max(ts.max() for ts in stamps)
+    now=pd.Timestamp(datetime.utcnow())
+
+    fleet={}
+    for device_id,(df,field,ts) in rows.items():
+        due=None
+        if pace:
+            due=(ts-first).dt.total_seconds().to_numpy()/speedup
+            if rebase:
+                ts=now+pd.to_timedelta(due,unit='s')
+        elif rebase:
+            ts=ts+(now-last)
+        fleet[device_id]=(serialize(df,field,ts),due)
+    print(f"Loaded {sum(len(p) for p,_ in fleet.values())} messages for {len(fleet)} devices, spanning {last-first}")
+    return fleet
+
+async def send_messages(device_client,payloads,due=None,limiter=None,concurrency=1,stats=None,test=False,verbose=False,label='',start=None):
+    '''
+    Send the payloads with at most concurrency sends in flight, each after its due time
+    (seconds from start, the loop time, now by default) when given, and within the limiter rate.
+    device_client is not used when test is set.
+    '''
+    import uuid
+
+    loop=asyncio.get_running_loop()
+    if start is None:
+        start=loop.time()
+    indexes=iter(range(len(payloads)))
+
+    async def sender():
+        for i in indexes:
+            lag=None
+            if due is not None:
+                await asyncio.sleep(max(0,start+due[i]-loop.time()))
+                lag=max(0,loop.time()-start-due[i])
+            if limiter is not None:
+                await limiter.acquire()
+            msg = azure.iot.device.Message(payloads[i])
+            msg.message_id = uuid.uuid4()
+            msg.correlation_id = f"corr{msg.message_id}"
+            t0=time.monotonic()
+            if not test:
+                await device_client.send_message(msg)
+            if stats is not None:
+                stats.add(len(payloads[i]),time.monotonic()-t0,lag)
+            if verbose:
+                print(f"{'Would send' if test else 'Sent'} {label}message #{1+i} {payloads[i]}")
+
+    await asyncio.gather(*[sender() for _ in range(max(1,concurrency))])
+
+async def connect(iothub_creds,device_id):
+    ''' Create and connect the IoT Hub client of a device '''
+    iot_hub_name=iothub_creds['iot_hub_name']
+    access_key=iothub_creds['devices_access_keys'][device_id][0]
+
+    # The connection string for a device should never be stored in code. For the sake of simplicity we're using an environment variable here.
+    conn_str=f"HostName={iot_hub_name}.azure-devices.net;DeviceId={device_id};SharedAccessKey={access_key}"
+
+    # The client object is used to interact with your Azure IoT hub.
+    device_client = azure.iot.device.aio.IoTHubDeviceClient.create_from_connection_string(conn_str)
 
     # Connect the client.
     await device_client.connect()
+    return device_client
+
+async def main(argv):
+
+    import argparse
+    parser = argparse.ArgumentParser(description=f"Tester for AMQPPreload iotfunction")
+    parser.add_argument('deviceId', type=str, help=f"Device ID (or csv file if omitted, in which case deviceId is the last part of filename after -@), or a directory of CSV files to replay a fleet of devices")
+    parser.add_argument('csvFile', type=str, help=f"Name of CSV file", nargs='?',default=None)
+    parser.add_argument('-count', type=int, help=f"Count of messages to send (per device)", default=10)
+    parser.add_argument('-offset', type=int, help=f"Offset of first message to send", default='0')
+    parser.add_argument('-norebase', help=f"Do not rebase time stamp from now", action='store_true')
+    parser.add_argument('-pace', help=f"Pace data sending, respecting timestamps intervals", action='store_true')
+    parser.add_argument('-maxDelayMult', type=float, help=f"When pacing, clip time gaps that are over x times the previous value (single device)", default=1.5)
+    parser.add_argument('-speedup', type=float, help=f"When pacing, time compression factor applied to the time gaps", default=1.0)
+    parser.add_argument('-dateField', type=str, help=f"Date field, default to first column", default=None)
+    parser.add_argument('-pattern', type=str, help=f"CSV files of the fleet directory", default='*.csv')
+    parser.add_argument('-rate', type=float, help=f"Maximum messages per second, for all devices, unlimited if 0", default=0)
+    parser.add_argument('-burst', type=int, help=f"Messages that may be sent at once above the rate", default=None)
+    parser.add_argument('-concurrency', type=int, help=f"Messages being sent at the same time (per device)", default=1)
+    parser.add_argument('-verbose', help=f"Print each message", action='store_true')
+    parser.add_argument('-test', help=f"Dry run: don't connect nor send, report the achieved throughput", action='store_true')
+    parser.add_argument('--iothubcreds', type=str, help=f"IoT Hub credentials file",default=os.path.join(os.path.dirname(__file__),f"creds_iothub_{os.environ.get('USERNAME',os.environ.get('USER'))}.json"))
+    args = parser.parse_args(argv[1:])
+
+    messages_to_send=args.count
+    offset=args.offset
+
+    if os.path.isdir(args.deviceId):
+        # Fleet mode, one device per CSV file
+        import glob
+        csv_files=sorted(glob.glob(os.path.join(args.deviceId,args.pattern)))
+        print(f"Replaying {len(csv_files)} CSV files from {args.deviceId}")
+        fleet=load_fleet(csv_files,offset,messages_to_send,args.dateField,not args.norebase,args.pace,args.speedup)
+    else:
+        device_id=args.deviceId
+        csv_file=args.csvFile
+        if csv_file is None:
+            csv_file=device_id
+            device_id=device_of(csv_file)
+        print(f"Using CSV file: {csv_file} and device {device_id}")
+        fleet={device_id:load_messages(csv_file,offset,messages_to_send,args.dateField,not args.norebase,args.pace,args.maxDelayMult,args.speedup)}
+
+    clients={device_id:None for device_id in fleet}
+    if not args.test:
+        with io.open(args.iothubcreds) as f:
+            iothub_creds = json.load(f)
+        print(f"Connecting {len(fleet)} devices to {iothub_creds['iot_hub_name']}, about to send {sum(len(p) for p,_ in fleet.values())} messages from offset {offset}")
+        connected=await asyncio.gather(*[connect(iothub_creds,device_id) for device_id in fleet],return_exceptions=True)
+        for device_id,client in zip(fleet,connected):
+            if isinstance(client,Exception):
+                print(f"Could not connect device {device_id}: {client}")
+            else:
+                clients[device_id]=client
 
-    async def send_message(df,i,ts):
-        import json,uuid
-        import collections
-
-        # Create a JSON string representation with keys in the same order as the CSV columns
-        msg=df[original_columns].iloc[i].to_dict(into=collections.OrderedDict)
-        msg[date_field]=str(ts)
-        msg = azure.iot.device.Message(json.dumps(msg))
-        msg.message_id = uuid.uuid4()
-        msg.correlation_id = f"corr{msg.message_id}"
-        # msg.custom_properties["tornado-warning"] = "yes"
-        if not args.test:
-            print(f"Sending message #{str(1+i)} at {datetime.utcnow()} {type(msg)} {msg}")
-            await device_client.send_message(msg)
-        else:
-            print(f"Would send message #{str(1+i)} at {datetime.utcnow()} {type(msg)} {msg}")
-
-    # send `messages_to_send` messages in sequence with pacing
-    #await asyncio.gather(*[send_message(df,i) for i in range(messages_to_send)])
-    import time
-    last_ts=None
-    last_deltaWaitSec=None
-    for i in range(messages_to_send):
-        ts=df.iloc[i][f"rebase_{date_field}"]
-        if args.pace and last_ts is not None:
-            deltaWaitSec=int((ts-last_ts).total_seconds())
-            if last_deltaWaitSec is not None and deltaWaitSec > int(last_deltaWaitSec * args.maxDelayMult):
-                print(f"Time gap {deltaWaitSec} > {last_deltaWaitSec}*{args.maxDelayMult}, clipping to {int(last_deltaWaitSec * args.maxDelayMult)}")
-                deltaWaitSec=int(last_deltaWaitSec * args.maxDelayMult)
-            print(f"Waiting for {deltaWaitSec:d} seconds at {datetime.utcnow()}")
-            time.sleep(deltaWaitSec)
-            last_deltaWaitSec=deltaWaitSec
-            ts=datetime.utcnow()
-        await send_message(df,i,ts)
-        last_ts=ts
-
-    # finally, disconnect
-    await device_client.disconnect()
+    # All devices share the rate limit and the pacing start time
+    stats=SendStats()
+    limiter=TokenBucket(args.rate,args.burst)
+    start=asyncio.get_running_loop().time()
+    try:
+        await asyncio.gather(*[send_messages(clients[device_id],payloads,due,limiter,args.concurrency,stats,args.test,args.verbose,
+                                             label=f"{device_id} " if len(fleet)>1 else '',start=start)
+                               for device_id,(payloads,due) in fleet.items() if args.test or clients[device_id] is not None])
+    finally:
+        stats.report(f"{'Would send' if args.test else 'Sent'} from {len(fleet)} devices:" if len(fleet)>1 else ('Would send' if args.test else 'Sent'))
+        # finally, disconnect
+        await asyncio.gather(*[client.disconnect() for client in clients.values() if client is not None])
 
 if __name__ == "__main__":
     asyncio.run(main(sys.argv))
@@ -0,0 +1,67 @@
+# *****************************************************************************
+# # © Copyright IBM Corp. 2021.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+# Benchmark the PhGFilterMultiplicates filter on synthetic vibration frames
+#
+# Written by Philippe Gregoire, IBM France, Hybrid CLoud Build Team Europe
+# *****************************************************************************
+import sys,os,time
+
+import logging
+logger = logging.getLogger(__name__)
+
+def make_frame(rows,devices=10,nan_ratio=0.1,columns=None):
+    ''' Build a (id,date) indexed frame with some NaN values in the fft columns '''
+    import numpy as np, pandas as pd
+
+    if columns is None:
+        columns=[f"Order{o}_fft{f}" for o in (1,2,3) for f in ('V','G')]
+    rng=np.random.default_rng(0)
+    data=rng.normal(size=(rows,len(columns)))
+    data[rng.random(size=data.shape)<nan_ratio/len(columns)]=np.nan
+    df=pd.DataFrame(data,columns=columns)
+    df['deviceid']=np.repeat([f"dev{d}" for d in range(devices)],-(-rows//devices))[:rows]
+    df['evt_timestamp']=pd.Timestamp('2021-01-01')+pd.to_timedelta(np.arange(rows)%(-(-rows//devices)),unit='s')
+    df.set_index(['deviceid','evt_timestamp'],drop=False,inplace=True)
+    return df,columns
+
+def legacy_filter(df,drop_if_NaN):
+    ''' The former row-by-row NaN screening, for comparison '''
+    import math
+    return df[df[drop_if_NaN].apply(lambda row: all([not math.isnan(c) for c in row]),axis=1)]
+
+def main(argv):
+    sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),'..')))
+
+    import argparse
+    parser = argparse.ArgumentParser(description=f"Benchmark for PhGFilterMultiplicates iotfunction")
+    parser.add_argument('-rows', type=int, help=f"Row counts to benchmark", nargs='*', default=[100_000,1_000_000,10_000_000])
+    parser.add_argument('-legacy', help=f"Also time the former row-wise apply (slow above 1M rows)", action='store_true')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.WARNING)
+
+    import phg_iotfuncs.func_base
+    for rows in args.rows:
+        df,columns=make_frame(rows)
+        fn=phg_iotfuncs.func_base.PhGFilterMultiplicates(columns,'evt_timestamp',['min'])
+
+        t0=time.perf_counter()
+        out=fn.filter(df)
+        elapsed=time.perf_counter()-t0
+        print(f"rows={rows:>11,d} kept={len(out):>11,d} filter {elapsed:8.3f}s {rows/elapsed:>14,.0f} rows/s")
+
+        if args.legacy:
+            t0=time.perf_counter()
+            legacy_filter(df,columns)
+            elapsed=time.perf_counter()-t0
+            print(f"rows={rows:>11,d} {'':17s} legacy {elapsed:8.3f}s {rows/elapsed:>14,.0f} rows/s")
+
+if __name__ == "__main__":
+    main(sys.argv)
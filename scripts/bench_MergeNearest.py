@@ -0,0 +1,75 @@
+# *****************************************************************************
+# # © Copyright IBM Corp. 2021.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+# Benchmark the nearest as-of merge engine of MergeSampleTimeSeries against
+# pandas merge_asof, on synthetic per-entity series
+#
+# Written by Philippe Gregoire, IBM France, Hybrid CLoud Build Team Europe
+# *****************************************************************************
+import sys,os,time
+
+import logging
+logger = logging.getLogger(__name__)
+
+def make_frames(rows,entities,source_ratio=0.1):
+    ''' Entity rows every second per entity, source rows at random times '''
+    import numpy as np, pandas as pd
+
+    rng=np.random.default_rng(0)
+    ids=np.asarray([f"entity{i}" for i in range(entities)])
+    per_entity=-(-rows//entities)
+    left=pd.DataFrame({'id':np.repeat(ids,per_entity)[:rows],
+                       'evt_timestamp':pd.Timestamp('2021-01-01')+pd.to_timedelta(np.tile(np.arange(per_entity),entities)[:rows],unit='s')})
+    n=int(rows*source_ratio)
+    right=pd.DataFrame({'deviceid':rng.choice(ids,n),
+                        'evt_timestamp':pd.Timestamp('2021-01-01')+pd.to_timedelta(rng.integers(0,per_entity,n),unit='s'),
+                        'temp':rng.normal(size=n),'pressure':rng.normal(size=n)})
+    return left,right
+
+def main(argv):
+    sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),'..')))
+
+    import argparse
+    parser = argparse.ArgumentParser(description=f"Benchmark for the MergeSampleTimeSeries nearest merge")
+    parser.add_argument('-rows', type=int, help=f"Entity rows", nargs='*', default=[1_000_000,10_000_000])
+    parser.add_argument('-entities', type=int, help=f"Number of entities", default=1000)
+    parser.add_argument('-workers', type=int, help=f"Threads of the merge engine", default=None)
+    parser.add_argument('-tolerance', help=f"Merge tolerance", default='1min')
+    parser.add_argument('-direction', help=f"Merge direction", default='nearest')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.WARNING)
+
+    import pandas as pd
+    from phg_iotfuncs.functions import mergeNearest
+
+    for rows in args.rows:
+        left,right=make_frames(rows,args.entities)
+
+        t0=time.perf_counter()
+        merged=mergeNearest(left['id'],left['evt_timestamp'],right,'deviceid','evt_timestamp',['temp','pressure'],
+                            tolerance=args.tolerance,direction=args.direction,n_workers=args.workers)
+        t_engine=time.perf_counter()-t0
+
+        # merge_asof needs both sides sorted on the timestamp, then the original order back
+        t0=time.perf_counter()
+        ls=left.reset_index().sort_values('evt_timestamp',kind='stable')
+        rs=right.sort_values('evt_timestamp',kind='stable')
+        ref=pd.merge_asof(ls,rs,on='evt_timestamp',left_by='id',right_by='deviceid',
+                          tolerance=pd.Timedelta(args.tolerance),direction=args.direction).set_index('index').sort_index()
+        t_asof=time.perf_counter()-t0
+
+        import numpy as np
+        matched=(~np.isnan(merged['temp'])).sum()
+        same=np.array_equal(merged['temp'],ref['temp'].to_numpy(),equal_nan=True)
+        print(f"rows={rows:>11,d} matched={matched:>11,d} mergeNearest {t_engine:7.3f}s {rows/t_engine:>13,.0f} rows/s"
+              f"   merge_asof {t_asof:7.3f}s {rows/t_asof:>13,.0f} rows/s   identical={same}")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,90 @@
+# *****************************************************************************
+# # © Copyright IBM Corp. 2021.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+# Benchmark the memory of N pipeline worker processes holding the same model,
+# unpickled in each worker versus memory-mapped from the joblib disk cache
+# (PHG_IOTFUNCS_MODEL_MMAP). Linux only, memory is read from /proc/self/smaps_rollup
+#
+# Written by Philippe Gregoire, IBM France, Hybrid CLoud Build Team Europe
+# *****************************************************************************
+import sys,os,io,time,pickle,tempfile
+import multiprocessing
+
+import logging
+logger = logging.getLogger(__name__)
+
+def memory_mb():
+    ''' (rss, private) memory of the current process in MB '''
+    values={}
+    with io.open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts=line.split()
+            if len(parts)>=2 and parts[0].endswith(':') and parts[1].isdigit():
+                values[parts[0][:-1]]=int(parts[1])
+    return values['Rss']/1024,(values.get('Private_Clean',0)+values.get('Private_Dirty',0))/1024
+
+def worker(mode,path,X,barrier,results):
+    import joblib
+    base_rss,base_private=memory_mb()
+    if mode=='pickle':
+        with io.open(path,'rb') as f:
+            model=pickle.load(f)
+    else:
+        model=joblib.load(path,mmap_mode='r')
+    model.predict(X)
+    rss,private=memory_mb()
+    results.put((rss-base_rss,private-base_private))
+    # Stay alive until all workers are measured, so pages are really shared
+    barrier.wait()
+
+def run(mode,path,X,workers):
+    ctx=multiprocessing.get_context('spawn')
+    barrier=ctx.Barrier(workers)
+    results=ctx.Queue()
+    procs=[ctx.Process(target=worker,args=(mode,path,X,barrier,results)) for _ in range(workers)]
+    for p in procs: p.start()
+    measures=[results.get() for _ in procs]
+    for p in procs: p.join()
+    return sum(m[0] for m in measures),sum(m[1] for m in measures)
+
+def main(argv):
+    sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),'..')))
+
+    import argparse
+    parser = argparse.ArgumentParser(description=f"Benchmark of memory-mapped model loading for PredictSKLearn")
+    parser.add_argument('-workers', type=int, help=f"Number of worker processes", default=4)
+    parser.add_argument('-rows', type=int, help=f"Training rows, drives the model size", default=1_000_000)
+    parser.add_argument('-features', type=int, help=f"Number of features", default=20)
+    args = parser.parse_args(argv[1:])
+
+    import numpy as np, joblib
+    from sklearn.neighbors import KNeighborsRegressor
+    from sklearn.ensemble import RandomForestRegressor
+
+    rng=np.random.default_rng(0)
+    X=rng.normal(size=(args.rows,args.features))
+    y=X[:,0]+rng.normal(size=args.rows)
+    Xtest=X[:100]
+    models={'KNeighborsRegressor':KNeighborsRegressor(algorithm='brute').fit(X,y),
+            'RandomForestRegressor':RandomForestRegressor(n_estimators=20,min_samples_leaf=5,n_jobs=-1).fit(X[:200_000],y[:200_000])}
+
+    tmp=tempfile.mkdtemp()
+    for name,model in models.items():
+        pkl=os.path.join(tmp,name+'.pkl')
+        with io.open(pkl,'wb') as f:
+            pickle.dump(model,f)
+        jbl=os.path.join(tmp,name+'.joblib')
+        joblib.dump(model,jbl)
+        size=os.path.getsize(pkl)/1048576
+        for mode,path in (('pickle',pkl),('mmap',jbl)):
+            rss,private=run(mode,path,Xtest,args.workers)
+            print(f"{name:22s} {size:8.1f}MB x {args.workers} workers {mode:6s}: RSS +{rss:8.1f}MB private +{private:8.1f}MB")
+
+if __name__ == "__main__":
+    main(sys.argv)
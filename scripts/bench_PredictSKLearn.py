@@ -0,0 +1,75 @@
+# *****************************************************************************
+# # © Copyright IBM Corp. 2021.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+# Benchmark the PredictSKLearn predict path: DataFrame selection versus the
+# contiguous feature matrix built by model_utils.featureMatrix
+#
+# Written by Philippe Gregoire, IBM France, Hybrid CLoud Build Team Europe
+# *****************************************************************************
+import sys,os,time,tracemalloc
+
+import logging
+logger = logging.getLogger(__name__)
+
+def make_frame(rows,features):
+    ''' Mixed-dtype entity frame as delivered by the pipeline '''
+    import numpy as np, pandas as pd
+
+    rng=np.random.default_rng(0)
+    df=pd.DataFrame({'deviceid':['dev0']*rows})
+    # Pipeline frames get their items added one at a time, so are not consolidated
+    for i in range(features):
+        df[f"x{i}"]=rng.normal(size=rows)
+    df['evt_timestamp']=pd.Timestamp('2021-01-01')+pd.to_timedelta(np.arange(rows),unit='s')
+    df['eventtype']='Telemetry'
+    return df
+
+def measure(fn):
+    ''' Run fn, return (seconds, traced peak MB) '''
+    tracemalloc.start()
+    t0=time.perf_counter()
+    fn()
+    elapsed=time.perf_counter()-t0
+    _,peak=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed,peak/1048576
+
+def main(argv):
+    sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),'..')))
+
+    import argparse
+    parser = argparse.ArgumentParser(description=f"Benchmark for PredictSKLearn feature matrix preparation")
+    parser.add_argument('-rows', type=int, help=f"Rows to score", nargs='*', default=[100_000,1_000_000])
+    parser.add_argument('-features', type=int, help=f"Number of feature columns", default=20)
+    parser.add_argument('-trees', type=int, help=f"Number of trees of the random forest", default=20)
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.WARNING)
+
+    from sklearn.ensemble import RandomForestRegressor
+    from phg_iotfuncs import model_utils
+
+    train=make_frame(10_000,args.features)
+    features=[f"x{i}" for i in range(args.features)]
+    model=RandomForestRegressor(n_estimators=args.trees,max_depth=10,n_jobs=1).fit(train[features],train['x0'])
+
+    import numpy as np
+    from sklearn.utils import check_array
+    for rows in args.rows:
+        df=make_frame(rows,args.features)
+        # Input preparation only: selection plus the float32 conversion done inside predict()
+        t_df,m_df=measure(lambda: check_array(df[features],dtype=np.float32))
+        t_fm,m_fm=measure(lambda: model_utils.featureMatrix(model,df,features))
+        print(f"rows={rows:>10,d} prepare  DataFrame: {t_df:7.3f}s peak {m_df:8.1f}MB   featureMatrix: {t_fm:7.3f}s peak {m_fm:8.1f}MB")
+        t_df,m_df=measure(lambda: model.predict(df[features]))
+        t_fm,m_fm=measure(lambda: model.predict(model_utils.featureMatrix(model,df,features)))
+        print(f"rows={rows:>10,d} predict  DataFrame: {t_df:7.3f}s peak {m_df:8.1f}MB   featureMatrix: {t_fm:7.3f}s peak {m_fm:8.1f}MB")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -18,4 +18,4 @@ setup(name='phg_iotfuncs', version='0.0.9',
       packages=find_packages(),
       #package_data={"phg_iotfuncs":["*.csv"]},
       install_requires=['iotfunctions@git+https://github.com/ibm-watson-iot/functions.git@production','uamqp'],
-      extras_require={'kafka': ['confluent-kafka==0.11.5']})
+      extras_require={'kafka': ['confluent-kafka==0.11.5'], 'parquet': ['pyarrow']})